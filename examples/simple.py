@@ -8,4 +8,4 @@ db.store({"a": ([3, 4, 5], [0.35, 0.45, 0.55])})
 
 res = db.get("a", 2, 4).to_dict()
 
-res == {"a": (array([2, 3, 4]), array([0.2, 0.3, 0.45]))}
+res == {"a": (array([2, 3, 4]), array([0.2, 0.35, 0.45]))}
@@ -5,5 +5,19 @@ from .version import __version__
 from .data import Data, DataSet
 from .page import Page
 from .pagestore import PageStore
+from .buffer import WriteBuffer
+from .snapshot import Snapshot
+from .filters import Cond
+from .aio import AsyncPageStore
 
-__all__ = ["PageStore", "Page", "Data", "DataSet", "__version__"]
+__all__ = [
+    "PageStore",
+    "Page",
+    "Data",
+    "DataSet",
+    "WriteBuffer",
+    "Snapshot",
+    "Cond",
+    "AsyncPageStore",
+    "__version__",
+]
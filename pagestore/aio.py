@@ -0,0 +1,96 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .data import DataSet
+
+
+class AsyncPageStore:
+    """
+    Asyncio facade of a PageStore.
+
+    Catalog and file operations run in a pool of max_workers threads, so
+    that concurrent requests overlap their I/O without blocking the event
+    loop. Writes of the same name wait for each other in the event loop
+    instead of holding a worker thread. The PageStore serializes the
+    transactions of writes of different names.
+    """
+
+    def __init__(self, db, max_workers=4):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.name_locks = {}
+
+    def __repr__(self):
+        return f"<AsyncPageStore of {self.db!r}>"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def run(self, func, *args, **kwargs):
+        """run func in the executor and return its result"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    def name_lock(self, name):
+        if name not in self.name_locks:
+            self.name_locks[name] = asyncio.Lock()
+        return self.name_locks[name]
+
+    async def search(self, pattern="%"):
+        return await self.run(self.db.search, pattern)
+
+    async def get_names(self, pattern_or_list=""):
+        return await self.run(self.db.get_names, pattern_or_list)
+
+    async def get_data(self, name, idx1=-np.infty, idx2=np.infty, **kwargs):
+        """return data of name between idx1 and idx2, see PageStore.get_data"""
+        return await self.run(self.db.get_data, name, idx1, idx2, **kwargs)
+
+    async def get(self, pattern_or_list, idx1=-np.infty, idx2=np.infty):
+        """return a DataSet of the names, read concurrently"""
+        names = await self.get_names(pattern_or_list)
+        datalist = await asyncio.gather(
+            *(self.get_data(name, idx1, idx2) for name in names)
+        )
+        res = {name: data for name, data in zip(names, datalist) if data is not None}
+        return DataSet(res)
+
+    async def iter_data(self, name, idx1=-np.infty, idx2=np.infty, chunk=None):
+        """yield data of name between idx1 and idx2, see PageStore.iter_data"""
+        datalist = self.db.iter_data(name, idx1, idx2, chunk)
+        while True:
+            data = await self.run(next, datalist, None)
+            if data is None:
+                return
+            yield data
+
+    async def store_data(self, data):
+        async with self.name_lock(data.name):
+            await self.run(self.db.store_data, data)
+
+    async def store(self, dataset):
+        """store a dataset or a dict of data in a single transaction"""
+        names = sorted(dataset)
+        # locks taken in order, so that concurrent stores cannot deadlock
+        for name in names:
+            await self.name_lock(name).acquire()
+        try:
+            await self.run(self.db.store, dataset)
+        finally:
+            for name in names:
+                self.name_lock(name).release()
+
+    async def flush(self):
+        await self.run(self.db.flush)
+
+    async def close(self):
+        """close the store, flushing buffered data, and the executor"""
+        await self.run(self.db.close)
+        self.executor.shutdown()
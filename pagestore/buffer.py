@@ -0,0 +1,107 @@
+import os
+import pickle
+import time
+
+from .data import Data
+
+
+class WriteBuffer:
+    """
+    In memory buffer of data per name used by PageStore to group small writes.
+
+    The buffer is due to be flushed when it holds more than max_size bytes of
+    records, more than max_count records or data older than max_age seconds.
+    If walfile is given, buffered data is appended to a write-ahead log and
+    replayed when the buffer is created again after a crash.
+    """
+
+    def __init__(self, max_size=10000000, max_count=None, max_age=None, walfile=None):
+        self.max_size = max_size
+        self.max_count = max_count
+        self.max_age = max_age
+        self.walfile = walfile
+        self.dataset = {}
+        self.size = 0
+        self.count = 0
+        self.since = None
+        self.wal = None
+        if walfile is not None:
+            self.replay()
+            self.wal = open(walfile, "ab")
+
+    def replay(self):
+        """load data from the write-ahead log, dropping a torn last entry"""
+        if not os.path.exists(self.walfile):
+            return
+        with open(self.walfile, "r+b") as fh:
+            while True:
+                pos = fh.tell()
+                try:
+                    name, idx, rec = pickle.load(fh)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    fh.truncate(pos)
+                    break
+                self.add(Data(idx, rec, name))
+
+    def add(self, data):
+        if self.since is None:
+            self.since = time.monotonic()
+        old = self.dataset.get(data.name)
+        if old is not None:
+            self.size -= old.get_size()
+            self.count -= len(old)
+            data, replaced = old.merge(data)
+        self.dataset[data.name] = data
+        self.size += data.get_size()
+        self.count += len(data)
+
+    def store_data(self, data):
+        """buffer sorted data, logging it first if a write-ahead log is used"""
+        if self.wal is not None:
+            pickle.dump((data.name, data.idx, data.rec), self.wal)
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+        self.add(data)
+
+    def get(self, name):
+        return self.dataset.get(name)
+
+    def is_due(self):
+        return self.max_age is not None and self.age() >= self.max_age
+
+    def is_full(self):
+        if self.max_size is not None and self.size >= self.max_size:
+            return True
+        if self.max_count is not None and self.count >= self.max_count:
+            return True
+        return self.is_due()
+
+    def age(self):
+        if self.since is None:
+            return 0
+        return time.monotonic() - self.since
+
+    def clear(self):
+        """empty the buffer and the write-ahead log, after data has been stored"""
+        self.dataset = {}
+        self.size = 0
+        self.count = 0
+        self.since = None
+        if self.wal is not None:
+            self.wal.truncate(0)
+            self.wal.seek(0)
+            os.fsync(self.wal.fileno())
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        return self.dataset.__iter__()
+
+    def __contains__(self, name):
+        return name in self.dataset
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """
+    Least recently used cache of page arrays keyed by Page.cache_key().
+
+    Cached arrays are made read-only, the total size of idx and rec is kept
+    below max_size bytes by evicting the least recently used pages.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.pages = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """return (idx, rec) of key or None"""
+        with self.lock:
+            res = self.pages.get(key)
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.pages.move_to_end(key)
+            return res
+
+    def put(self, key, idx, rec):
+        size = idx.nbytes + rec.nbytes
+        with self.lock:
+            self.pop(key)
+            if size > self.max_size:
+                return
+            idx.flags.writeable = False
+            rec.flags.writeable = False
+            self.pages[key] = idx, rec
+            self.size += size
+            while self.size > self.max_size:
+                _, (idx, rec) = self.pages.popitem(last=False)
+                self.size -= idx.nbytes + rec.nbytes
+
+    def invalidate(self, key):
+        with self.lock:
+            self.pop(key)
+
+    def pop(self, key):
+        res = self.pages.pop(key, None)
+        if res is not None:
+            idx, rec = res
+            self.size -= idx.nbytes + rec.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "pages": len(self.pages),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, key):
+        return key in self.pages
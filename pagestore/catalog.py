@@ -0,0 +1,172 @@
+import numpy as np
+
+
+class PageIndex:
+    """
+    Pages of a name sorted by begin, with begin and end arrays for binary search.
+    Pages do not overlap, therefore ends are sorted as well.
+    """
+
+    def __init__(self, pages=()):
+        self.pages = sorted(pages, key=lambda page: page.begin)
+        self.update()
+
+    def update(self):
+        """build the begin and end arrays from the pages"""
+        self.begins = np.array([page.begin for page in self.pages])
+        self.ends = np.array([page.end for page in self.pages])
+
+    def insert(self, page):
+        ii = np.searchsorted(self.begins, page.begin, side="right")
+        self.pages.insert(ii, page)
+        begins = np.insert(self.begins, ii, page.begin)
+        ends = np.insert(self.ends, ii, page.end)
+        if len(self.pages) == 1 or begins[ii] != page.begin or ends[ii] != page.end:
+            # the type of the arrays cannot hold the new values
+            self.update()
+        else:
+            self.begins = begins
+            self.ends = ends
+
+    def remove(self, page):
+        ii1 = np.searchsorted(self.begins, page.begin, side="left")
+        ii2 = np.searchsorted(self.begins, page.begin, side="right")
+        for ii in range(ii1, ii2):
+            if self.pages[ii].pageid == page.pageid:
+                break
+        else:
+            # begin changed since the page was inserted
+            ii = [page.pageid for page in self.pages].index(page.pageid)
+        del self.pages[ii]
+        self.begins = np.delete(self.begins, ii)
+        self.ends = np.delete(self.ends, ii)
+
+    def before(self, idx):
+        """last page with begin <= idx"""
+        ii = np.searchsorted(self.begins, idx, side="right") - 1
+        if ii >= 0:
+            return self.pages[ii]
+
+    def prev(self, idx):
+        """last page with begin < idx"""
+        ii = np.searchsorted(self.begins, idx, side="left") - 1
+        if ii >= 0:
+            return self.pages[ii]
+
+    def after(self, idx):
+        """first page with begin > idx"""
+        ii = np.searchsorted(self.begins, idx, side="right")
+        if ii < len(self.pages):
+            return self.pages[ii]
+
+    def between(self, idx1, idx2):
+        """pages with end >= idx1 and begin <= idx2"""
+        ii1 = np.searchsorted(self.ends, idx1, side="left")
+        ii2 = np.searchsorted(self.begins, idx2, side="right")
+        return self.pages[ii1:ii2]
+
+    def begin_between(self, idx1, idx2):
+        """pages with idx1 < begin <= idx2"""
+        ii1 = np.searchsorted(self.begins, idx1, side="right")
+        ii2 = np.searchsorted(self.begins, idx2, side="right")
+        return self.pages[ii1:ii2]
+
+    def __len__(self):
+        return len(self.pages)
+
+
+class Catalog:
+    """
+    In memory copy of the pages table, used by PageStore to answer page
+    lookups without queries and to allocate pageids from a counter.
+    """
+
+    def __init__(self, pages=()):
+        self.names = {}
+        self.pageids = {}
+        self.next_pageid = 0
+        self.add_pages(pages)
+
+    def add_pages(self, pages):
+        """add the pages of names not in the catalog, sorting each name once"""
+        names = {}
+        for page in pages:
+            self.pageids[page.pageid] = page
+            names.setdefault(page.name, []).append(page)
+            self.next_pageid = max(self.next_pageid, page.pageid + 1)
+        for name, pages in names.items():
+            self.names[name] = PageIndex(pages)
+
+    def replace_names(self, names, pages):
+        """replace all the pages of names with pages"""
+        for name in names:
+            index = self.names.pop(name, None)
+            if index is not None:
+                for page in index.pages:
+                    del self.pageids[page.pageid]
+        self.add_pages(pages)
+
+    def insert(self, page):
+        """insert or replace page"""
+        if page.pageid in self.pageids:
+            self.remove(page.pageid)
+        if page.name not in self.names:
+            self.names[page.name] = PageIndex()
+        self.names[page.name].insert(page)
+        self.pageids[page.pageid] = page
+        self.next_pageid = max(self.next_pageid, page.pageid + 1)
+
+    def remove(self, pageid):
+        page = self.pageids.pop(pageid, None)
+        if page is not None:
+            index = self.names[page.name]
+            index.remove(page)
+            if len(index) == 0:
+                del self.names[page.name]
+
+    def new_pageid(self):
+        pageid = self.next_pageid
+        self.next_pageid += 1
+        return pageid
+
+    def get_page(self, pageid):
+        return self.pageids.get(pageid)
+
+    def get_pages(self, name):
+        if name not in self.names:
+            return []
+        return list(self.names[name].pages)
+
+    def get_page_before(self, name, idx):
+        if name in self.names:
+            return self.names[name].before(idx)
+
+    def get_page_prev(self, name, idx):
+        if name in self.names:
+            return self.names[name].prev(idx)
+
+    def get_page_after(self, name, idx):
+        if name in self.names:
+            return self.names[name].after(idx)
+
+    def get_last_page(self, name):
+        if name in self.names:
+            return self.names[name].pages[-1]
+
+    def get_pages_between(self, name, idx1, idx2):
+        if name not in self.names:
+            return []
+        return self.names[name].between(idx1, idx2)
+
+    def get_pages_begin_between(self, name, idx1, idx2):
+        if name not in self.names:
+            return []
+        return self.names[name].begin_between(idx1, idx2)
+
+    def count_pages(self, name):
+        if name not in self.names:
+            return 0
+        return len(self.names[name])
+
+    def count_records(self, name):
+        return sum(page.count for page in self.get_pages(name))
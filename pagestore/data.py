@@ -1,5 +1,7 @@
 import numpy as np
 
+from .filters import where_mask
+
 
 class Data:
     """
@@ -13,8 +15,8 @@ class Data:
         return hasattr(data, "idx") and hasattr(data, "rec") and hasattr(data, "name")
 
     def __init__(self, idx, rec, name=""):
-        self.idx = np.array(idx)
-        self.rec = np.array(rec)
+        self.idx = np.asarray(idx)
+        self.rec = np.asarray(rec)
         if len(self.rec) != len(self.idx):
             raise ValueError(
                 f"Length mismatch idx/rec {len(self.idx)}!={len(self.rec)}"
@@ -32,8 +34,19 @@ class Data:
         return left, right
 
     def cut_lt(self, threshold):
-        ic = np.where(self.idx < threshold)[0][-1]
-        return self.cut_idx(ic + 1)
+        return self.cut_idx(np.searchsorted(self.idx, threshold, side="left"))
+
+    def split(self, thresholds):
+        """
+        Split data in len(thresholds)+1 parts, part i containing
+        thresholds[i-1] <= idx < thresholds[i]
+        """
+        icuts = np.searchsorted(self.idx, thresholds, side="left")
+        bounds = np.concatenate(([0], icuts, [len(self.idx)]))
+        return [
+            Data(self.idx[ii1:ii2], self.rec[ii1:ii2], self.name)
+            for ii1, ii2 in zip(bounds[:-1], bounds[1:])
+        ]
 
     def cut_nbytes(self, nbytes):
         guess = int(nbytes / self.get_size() * len(self))
@@ -70,47 +83,27 @@ class Data:
             return newdata, replaced
 
         # data overlap do full merge
-        newrec = []
-        newidx = []
-        oldrec = []
-        oldidx = []
-        ii = 0
-        jj = 0
-        while ii < len(self.idx) and jj < len(data.idx):
-            # print(ii,jj, self.idx[ii], data.idx[jj],newidx)
-            if self.idx[ii] == data.idx[jj]:
-                # replacing
-                newrec.append(data.rec[jj])
-                newidx.append(data.idx[jj])
-                oldrec.append(self.rec[ii])
-                oldidx.append(self.idx[ii])
-                ii += 1
-                jj += 1
-            else:
-                if self.idx[ii] < data.idx[jj]:
-                    # adding self
-                    newrec.append(self.rec[ii])
-                    newidx.append(self.idx[ii])
-                    ii += 1
-                else:
-                    # adding data
-                    newrec.append(data.rec[jj])
-                    newidx.append(data.idx[jj])
-                    jj += 1
-        while ii < len(self.idx):
-            # finishing self
-            newrec.append(self.rec[ii])
-            newidx.append(self.idx[ii])
-            ii += 1
-        while jj < len(data.idx):
-            # finishing data
-            newrec.append(data.rec[jj])
-            newidx.append(data.idx[jj])
-            jj += 1
-        newrec = np.array(newrec)
-        newidx = np.array(newidx)
-        oldrec = np.array(oldrec)
-        oldidx = np.array(oldidx)
+        # locate the entries of self that are replaced by data
+        pos = np.searchsorted(data.idx, self.idx)
+        replaced = np.zeros(len(self.idx), dtype=bool)
+        inside = pos < len(data.idx)
+        replaced[inside] = data.idx[pos[inside]] == self.idx[inside]
+        kept = ~replaced
+        keepidx = self.idx[kept]
+        keeprec = self.rec[kept]
+        # kept and data are disjoint: compute final positions of both
+        ikeep = np.arange(len(keepidx)) + np.searchsorted(data.idx, keepidx)
+        idata = np.arange(len(data.idx)) + np.searchsorted(keepidx, data.idx)
+        count = len(keepidx) + len(data.idx)
+        newidx = np.empty(count, dtype=np.result_type(keepidx, data.idx))
+        newidx[ikeep] = keepidx
+        newidx[idata] = data.idx
+        rectype = np.concatenate((keeprec[:0], data.rec[:0])).dtype
+        newrec = np.empty((count,) + data.rec.shape[1:], dtype=rectype)
+        newrec[ikeep] = keeprec
+        newrec[idata] = data.rec
+        oldidx = self.idx[replaced]
+        oldrec = self.rec[replaced]
         return Data(newidx, newrec, self.name), Data(oldidx, oldrec, self.name)
 
     def get_size(self):
@@ -126,16 +119,25 @@ class Data:
         rec = np.concatenate((self.rec, data.rec))
         return Data(idx, rec, self.name)
 
+    @staticmethod
+    def concatenate_list(datalist):
+        """concatenate a non empty list of data in a single copy"""
+        if len(datalist) == 1:
+            return datalist[0]
+        idx = np.concatenate([data.idx for data in datalist])
+        rec = np.concatenate([data.rec for data in datalist])
+        return Data(idx, rec, datalist[0].name)
+
     def delete(self, idx1, idx2):
-        ii1 = np.where(self.idx >= idx1)[0][0]
-        ii2 = np.where(self.idx <= idx2)[0][-1] + 1
+        ii1 = np.searchsorted(self.idx, idx1, side="left")
+        ii2 = np.searchsorted(self.idx, idx2, side="right")
         self.idx = self.idx[ii1:ii2]
         self.rec = self.rec[ii1:ii2]
         # return self
 
     def trim(self, idx1, idx2):
-        ii1 = np.where(self.idx >= idx1)[0][0]
-        ii2 = np.where(self.idx <= idx2)[0][-1] + 1
+        ii1 = np.searchsorted(self.idx, idx1, side="left")
+        ii2 = np.searchsorted(self.idx, idx2, side="right")
         return Data(self.idx[ii1:ii2], self.rec[ii1:ii2], self.name)
 
     def filter(self, mask):
@@ -147,8 +149,8 @@ class Data:
         return res
 
     def iter(self, idx1=None, idx2=None):
-        ii1 = None if idx1 is None else np.where(self.idx >= idx1)[0][0]
-        ii2 = None if idx2 is None else np.where(self.idx <= idx2)[0][-1] + 1
+        ii1 = None if idx1 is None else np.searchsorted(self.idx, idx1, side="left")
+        ii2 = None if idx2 is None else np.searchsorted(self.idx, idx2, side="right")
         for i, r in zip(self.idx[ii1:ii2], self.rec[ii1:ii2]):
             yield i, r
 
@@ -161,6 +163,7 @@ class Data:
         limit=None,
         skip=0,
         offset=0,
+        where=None,
     ):
         """
         Filter data based on the intersection of the following conditions
@@ -168,12 +171,13 @@ class Data:
           self.idx <= idx2
           map(idx_test,self.idx)
           map(rec_test,self.rec)
+          where, see mask
 
         The data is them down selected based on:
           idx[mask][offset:offset+limit:skip+1]
           rec[mask][offset:offset+limit:skip+1]
         """
-        mask = self.mask(idx1, idx2, idx_test, rec_test)
+        mask = self.mask(idx1, idx2, idx_test, rec_test, where)
         if limit is None:
             limit = len(self.idx)
         if filter is None:
@@ -195,6 +199,7 @@ class Data:
         limit=None,
         skip=0,
         offset=0,
+        where=None,
     ):
         """
         Count data based on the intersection of the following conditions
@@ -202,21 +207,24 @@ class Data:
           self.idx <= idx2
           map(idx_test,self.idx)
           map(rec_test,self.rec)
+          where, see mask
 
         The data is them down selected based on:
           idx[offset:offset+limit:skip]
         """
         if limit is None:
             limit = len(self.idx)
-        mask = self.mask(idx1, idx2, idx_test, rec_test)
+        mask = self.mask(idx1, idx2, idx_test, rec_test, where)
         return mask[offset : offset + limit : skip + 1].sum()
 
-    def mask(self, idx1=None, idx2=None, idx_test=None, rec_test=None):
+    def mask(self, idx1=None, idx2=None, idx_test=None, rec_test=None, where=None):
         """
         Return boolean mask based on the intersection of the following conditions
           self.idx >= idx1
           self.idx <= idx2
-          filter(self.idx,self.rec)
+          idx_test(idx) and rec_test(rec) for each record, slow
+          where: vectorized Cond, condition string like "x > 3",
+            function of the idx and rec arrays or list of them
         """
         mask = np.ones(len(self.idx), dtype=bool)
         if idx1 is not None:
@@ -227,8 +235,14 @@ class Data:
             mask &= np.fromiter(map(idx_test, self.idx), dtype=bool)
         if rec_test is not None:
             mask &= np.fromiter(map(rec_test, self.rec), dtype=bool)
+        if where is not None:
+            mask &= where_mask(where, self.idx, self.rec)
         return mask
 
+    def where(self, where):
+        """return the records matching where, see mask"""
+        return self.filter(where_mask(where, self.idx, self.rec))
+
     def mean(self):
         return self.rec.mean(axis=0)
 
@@ -286,10 +300,11 @@ class DataSet:
         limit=None,
         skip=0,
         offset=0,
+        where=None,
     ):
         res = {
             name: self.dataset[name].count(
-                idx1, idx2, idx_test, rec_test, limit, skip, offset
+                idx1, idx2, idx_test, rec_test, limit, skip, offset, where
             )
             for name in self.search(pattern_or_list)
         }
@@ -305,10 +320,11 @@ class DataSet:
         limit=None,
         skip=0,
         offset=0,
+        where=None,
     ):
         res = {
             name: self.dataset[name].select(
-                idx1, idx2, idx_test, rec_test, limit, skip, offset
+                idx1, idx2, idx_test, rec_test, limit, skip, offset, where
             )
             for name in self.search(pattern_or_list)
         }
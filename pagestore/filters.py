@@ -0,0 +1,99 @@
+import ast
+import operator
+import re
+
+import numpy as np
+
+
+class Cond:
+    """
+    Comparison of a record field, or of the records if field is None,
+    with a value, e.g. Cond("x", ">", 3) or Cond.parse("x > 3").
+    Records with several values match if any of their values matches.
+    """
+
+    ops = {
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "==": operator.eq,
+        "!=": operator.ne,
+    }
+
+    def __init__(self, field, op, value):
+        if op not in self.ops:
+            raise ValueError(f"Invalid operator {op!r}")
+        self.field = field
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def parse(cls, expr):
+        """parse 'field op value', field 'rec' compares the records"""
+        match = re.match(r"^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(.+?)\s*$", expr)
+        if match is None:
+            raise ValueError(f"Invalid condition {expr!r}")
+        field, op, value = match.groups()
+        field = None if field == "rec" else field
+        return cls(field, op, ast.literal_eval(value))
+
+    def __repr__(self):
+        field = "rec" if self.field is None else self.field
+        return f"Cond({field} {self.op} {self.value!r})"
+
+    def mask(self, idx, rec):
+        values = rec if self.field is None else rec[self.field]
+        res = self.ops[self.op](values, self.value)
+        if res.ndim > 1:
+            res = res.reshape(len(res), -1).any(axis=1)
+        return res
+
+    def can_match(self, stats):
+        """False if no record summarized by the page statistics can match"""
+        key = "" if self.field is None else self.field
+        if stats is None or key not in stats:
+            return True
+        vmin = np.asarray(stats[key]["min"])
+        vmax = np.asarray(stats[key]["max"])
+        if np.isnan(vmin).any() or np.isnan(vmax).any():
+            return True
+        value = self.value
+        if self.op in ("<", "<="):
+            res = self.ops[self.op](vmin, value)
+        elif self.op in (">", ">="):
+            res = self.ops[self.op](vmax, value)
+        elif self.op == "==":
+            res = (vmin <= value) & (value <= vmax)
+        else:
+            res = (vmin != value) | (vmax != value)
+        return bool(np.any(res))
+
+
+def where_mask(where, idx, rec):
+    """
+    Return the mask of the records matching where: a Cond, a condition
+    string, a function of the idx and rec arrays returning a mask
+    or a list of them that must all match
+    """
+    if isinstance(where, (list, tuple)):
+        mask = np.ones(len(idx), dtype=bool)
+        for cond in where:
+            mask &= where_mask(cond, idx, rec)
+        return mask
+    if isinstance(where, str):
+        where = Cond.parse(where)
+    if isinstance(where, Cond):
+        return where.mask(idx, rec)
+    return np.asarray(where(idx, rec), dtype=bool)
+
+
+def where_can_match(where, stats):
+    """False if the statistics exclude any match, functions can always match"""
+    if isinstance(where, (list, tuple)):
+        return all(where_can_match(cond, stats) for cond in where)
+    if isinstance(where, str):
+        where = Cond.parse(where)
+    if isinstance(where, Cond):
+        return where.can_match(stats)
+    return True
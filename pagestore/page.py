@@ -1,9 +1,15 @@
+import ast
+import hashlib
+import json
 import os
+import threading
+from functools import lru_cache
 
 import numpy as np
 import pickle
 
 from .data import Data
+from .stats import rec_stats, combine_stats
 
 
 def num2path(num):
@@ -14,18 +20,111 @@ def num2path(num):
     return os.path.join(*lst)
 
 
+def rec2type(rec):
+    """
+    Return a string describing dtype and shape of the records in rec
+    or None if rec can only be pickled (e.g. object arrays)
+    """
+    if rec.dtype.hasobject:
+        return None
+    descr = np.lib.format.dtype_to_descr(rec.dtype)
+    return repr((descr, rec.shape[1:]))
+
+
+# ast is not thread safe, rec_types are parsed once and one at a time
+parse_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def type2dtype(rec_type):
+    """Return the dtype of a single record from its rec_type string"""
+    with parse_lock:
+        descr, shape = ast.literal_eval(rec_type)
+    dtype = np.lib.format.descr_to_dtype(descr)
+    if len(shape) > 0:
+        dtype = np.dtype((dtype, shape))
+    return dtype
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+def raw_bytes(arr):
+    """contiguous bytes of arr as a uint8 array"""
+    return np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+
+
+def chain_hash(state, idx, rec, nblock):
+    """
+    Hash idx and rec in blocks of nblock records, each block together with
+    the digest of the previous ones starting from state. Return the digests
+    before and after the last block.
+    """
+    prev = state
+    for start in range(0, len(idx), nblock):
+        hasher = new_hash()
+        hasher.update(state)
+        hasher.update(raw_bytes(idx[start : start + nblock]))
+        hasher.update(raw_bytes(rec[start : start + nblock]))
+        prev, state = state, hasher.digest()
+    return prev, state
+
+
+def format_hash(prev, state):
+    """page hash: the final digest and the one before the last block"""
+    return f"{state.hex()}:{prev.hex()}"
+
+
 class Page:
+    # missing in pages written by older versions, that pickled the records
+    rec_type = None
+    version = 0
+    # content hash of the page files, missing in pages written by older versions
+    hash = None
+    # records are hashed in chained blocks of about hash_block_size bytes, so
+    # that appends hash again only the last block
+    hash_block_size = 1 << 16
+    # JSON statistics of the numeric record fields, see stats.rec_stats
+    stats = None
+
     @classmethod
-    def from_data(cls, pageid, data):
+    def from_data(cls, pageid, data, version=0):
         begin = data.idx[0]
         end = data.idx[-1]
         count = len(data)
         size = data.get_size()
         idx_type = data.idx.dtype.str
+        rec_type = rec2type(data.rec)
         name = data.name
-        return cls(pageid, name, begin, end, count, size, idx_type)
+        stats = json.dumps(rec_stats(data.rec))
+        return cls(
+            pageid,
+            name,
+            begin,
+            end,
+            count,
+            size,
+            idx_type,
+            rec_type,
+            version,
+            stats=stats,
+        )
 
-    def __init__(self, pageid, name, begin, end, count, size, idx_type):
+    def __init__(
+        self,
+        pageid,
+        name,
+        begin,
+        end,
+        count,
+        size,
+        idx_type,
+        rec_type=None,
+        version=0,
+        hash=None,
+        stats=None,
+    ):
         self.pageid = pageid
         self.name = name
         self.begin = begin
@@ -33,6 +132,11 @@ class Page:
         self.count = count
         self.size = size
         self.idx_type = idx_type
+        self.rec_type = rec_type
+        # a rewritten page keeps its pageid and gets new files with a new version
+        self.version = version
+        self.hash = hash
+        self.stats = stats
 
     def to_list(self):
         return (
@@ -43,14 +147,30 @@ class Page:
             self.count,
             self.size,
             self.idx_type,
+            self.rec_type,
+            self.version,
+            self.hash,
+            self.stats,
         )
 
     def __repr__(self):
         ss = ", ".join(map(str, self.to_list()))
         return f"Page({ss})"
 
+    def get_stats(self):
+        """return the record statistics per field, None if not computed"""
+        if self.stats is not None:
+            return json.loads(self.stats)
+
+    def cache_key(self):
+        """key identifying the page content, it changes when the page is modified"""
+        return self.pageid, self.version, self.count
+
     def get_prefix(self, pagedir):
-        return os.path.join(pagedir, num2path(self.pageid))
+        prefix = os.path.join(pagedir, num2path(self.pageid))
+        if self.version > 0:
+            prefix += f"_{self.version}"
+        return prefix
 
     def create_file(self, pagedir, extension):
         filename = self.get_prefix(pagedir) + extension
@@ -58,51 +178,273 @@ class Page:
         os.makedirs(head, exist_ok=True)
         return filename
 
-    def read_idx(self, pagedir):
+    def write_file(self, pagedir, extension, buf):
+        """
+        Write buf in a temporary file renamed when complete, so that a page
+        file is either missing or complete after a crash
+        """
+        filename = self.create_file(pagedir, extension)
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as fh:
+            fh.write(buf)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpname, filename)
+
+    def read_idx(self, pagedir, mmap=False):
         filename = self.get_prefix(pagedir) + ".idx"
+        if mmap:
+            return np.memmap(filename, dtype=self.idx_type, mode="r", shape=self.count)
         return np.fromfile(filename, dtype=self.idx_type, count=self.count)
 
     def write_idx(self, idx, pagedir):
-        filename = self.create_file(pagedir, ".idx")
-        idx.tofile(filename)
+        """write the index in raw binary format and return the bytes written"""
+        buf = raw_bytes(idx)
+        self.write_file(pagedir, ".idx", buf)
+        return buf
 
-    def read_rec(self, pagedir):
+    def read_rec(self, pagedir, mmap=False):
         filename = self.get_prefix(pagedir) + ".rec"
-        return pickle.load(open(filename, "rb"))
+        if self.rec_type is None:
+            # pickled records cannot be mapped and are always loaded in memory
+            return pickle.load(open(filename, "rb"))
+        dtype = type2dtype(self.rec_type)
+        if mmap:
+            return np.memmap(filename, dtype=dtype, mode="r", shape=self.count)
+        return np.fromfile(filename, dtype=dtype, count=self.count)
 
     def write_rec(self, rec, pagedir):
-        filename = self.get_prefix(pagedir) + ".rec"
-        pickle.dump(rec, open(filename, "wb"))
+        """
+        Write records in raw binary format, or pickled if rec_type is None,
+        and return the bytes written
+        """
+        if self.rec_type is None:
+            buf = pickle.dumps(rec)
+        else:
+            buf = raw_bytes(rec)
+        self.write_file(pagedir, ".rec", buf)
+        return buf
 
     def read_meta(self, pagedir):
         filename = self.get_prefix(pagedir) + ".page"
         return pickle.load(open(filename, "rb"))
 
     def write_meta(self, pagedir):
-        filename = self.get_prefix(pagedir) + ".page"
-        pickle.dump(self, open(filename, "wb"))
+        self.write_file(pagedir, ".page", pickle.dumps(self))
+
+    def locate(self, pagedir, idx1, idx2):
+        """
+        Return the range of records with idx1 <= idx <= idx2, searching
+        the mapped index file only if the page is not fully covered
+        """
+        if self.begin >= idx1 and self.end <= idx2:
+            return 0, self.count
+        idx = self.read_idx(pagedir, mmap=True)
+        ii1 = np.searchsorted(idx, idx1, side="left")
+        ii2 = np.searchsorted(idx, idx2, side="right")
+        return ii1, ii2
+
+    def read_into(self, pagedir, idx, rec, ii1=0):
+        """
+        Read len(idx) records starting from ii1 directly in the
+        preallocated contiguous arrays idx and rec
+        """
+        prefix = self.get_prefix(pagedir)
+        dtypes = [np.dtype(self.idx_type), type2dtype(self.rec_type)]
+        for extension, out, dtype in zip([".idx", ".rec"], [idx, rec], dtypes):
+            with open(prefix + extension, "rb") as fh:
+                fh.seek(ii1 * dtype.itemsize)
+                buf = out.view(np.uint8)
+                if fh.readinto(buf) != buf.nbytes:
+                    raise ValueError(f"{prefix + extension} is truncated")
+
+    def read_slice(self, pagedir, ii1, ii2):
+        """read records ii1 to ii2 excluded, reading only their bytes if raw"""
+        if self.rec_type is None:
+            data = self.read(pagedir)
+            return Data(data.idx[ii1:ii2], data.rec[ii1:ii2], self.name)
+        idx = np.empty(ii2 - ii1, dtype=self.idx_type)
+        rec = np.empty(ii2 - ii1, dtype=type2dtype(self.rec_type))
+        self.read_into(pagedir, idx, rec, ii1)
+        return Data(idx, rec, self.name)
+
+    def read_range(self, pagedir, idx1, idx2):
+        """read the records with idx1 <= idx <= idx2 using a binary search"""
+        ii1, ii2 = self.locate(pagedir, idx1, idx2)
+        return self.read_slice(pagedir, ii1, ii2)
 
-    def read(self, pagedir):
-        idx = self.read_idx(pagedir)
-        rec = self.read_rec(pagedir)
+    def read(self, pagedir, mmap=False):
+        """
+        Read page data, if mmap is True arrays are read-only views
+        of the page files
+        """
+        idx = self.read_idx(pagedir, mmap)
+        rec = self.read_rec(pagedir, mmap)
         return Data(idx, rec, self.name)
 
+    def hash_block(self):
+        """number of records in each block of the hash"""
+        rowsize = np.dtype(self.idx_type).itemsize
+        rowsize += type2dtype(self.rec_type).itemsize
+        return max(self.hash_block_size // rowsize, 1)
+
+    def hash_records(self, idx, rec, buf=None):
+        """
+        Return the hash of the records idx and rec, pickled records are
+        hashed in a single block with the pickle buf
+        """
+        if self.rec_type is None:
+            hasher = new_hash()
+            hasher.update(raw_bytes(idx))
+            hasher.update(buf)
+            return format_hash(b"", hasher.digest())
+        return format_hash(*chain_hash(b"", idx, rec, self.hash_block()))
+
+    def compute_hash(self, pagedir):
+        """hash the content of the page files, one block at a time"""
+        if self.rec_type is None:
+            filename = self.get_prefix(pagedir) + ".rec"
+            buf = np.fromfile(filename, dtype=np.uint8)
+            return self.hash_records(self.read_idx(pagedir), None, buf)
+        data = self.read(pagedir, mmap=True)
+        return self.hash_records(data.idx, data.rec)
+
+    def get_file_sizes(self):
+        """expected size of the raw page files"""
+        sizes = {".idx": self.count * np.dtype(self.idx_type).itemsize}
+        if self.rec_type is not None:
+            sizes[".rec"] = self.count * type2dtype(self.rec_type).itemsize
+        return sizes
+
+    def verify(self, pagedir, hash=True):
+        """
+        Return the list of problems found comparing the page with its meta
+        file and the size of its files and, if hash is True, the content of
+        its files. Pages without hash are read and described again.
+        """
+        errors = []
+        prefix = self.get_prefix(pagedir)
+        try:
+            meta = self.read_meta(pagedir)
+            if meta.to_list() != self.to_list():
+                errors.append(f"meta file differs: {meta}")
+            os.stat(prefix + ".rec")
+            for extension, size in self.get_file_sizes().items():
+                if os.path.getsize(prefix + extension) != size:
+                    errors.append(f"{extension[1:]} file size differs")
+            if not hash:
+                return errors
+            if self.hash is None:
+                data = self.read(pagedir)
+                page = Page.from_data(self.pageid, data, self.version)
+                if self.rec_type is None:
+                    # pickled records, even if they could be stored raw
+                    page.rec_type = None
+                if page.to_list()[:-2] != self.to_list()[:-2]:
+                    errors.append(f"data differs: {page}")
+            elif self.compute_hash(pagedir) != self.hash:
+                errors.append("hash differs")
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError) as ex:
+            errors.append(f"{type(ex).__name__}: {ex}")
+        return errors
+
+    def repair(self, pagedir):
+        """
+        Truncate the files left longer than the page by an interrupted
+        append and write the meta file again. Return True if the page
+        is then valid.
+        """
+        prefix = self.get_prefix(pagedir)
+        try:
+            for extension, size in self.get_file_sizes().items():
+                if os.path.getsize(prefix + extension) < size:
+                    return False
+                os.truncate(prefix + extension, size)
+        except FileNotFoundError:
+            return False
+        self.write_meta(pagedir)
+        return len(self.verify(pagedir)) == 0
+
     def check(self, pagedir):
-        page = self.read_meta(pagedir)
-        self.compare(page)
-        data = self.read(pagedir)
-        page = Page.from_data(self.pageid, data)
-        self.compare(page)
+        errors = self.verify(pagedir)
+        if len(errors) > 0:
+            raise ValueError(f"{self}: {'; '.join(errors)}")
 
     def write(self, data, pagedir):
+        """write page files and the meta file including the content hash"""
         self.write_idx(data.idx, pagedir)
-        self.write_rec(data.rec, pagedir)
+        buf = self.write_rec(data.rec, pagedir)
+        self.hash = self.hash_records(data.idx, data.rec, buf)
+        self.write_meta(pagedir)
+
+    def can_append(self, data):
+        """True if data can be appended to the page files"""
+        return (
+            self.rec_type is not None
+            and self.rec_type == rec2type(data.rec)
+            and self.idx_type == data.idx.dtype.str
+            and data.idx[0] > self.end
+        )
+
+    def append(self, data, pagedir):
+        """
+        Append data after the last record extending the page files in place,
+        synced to disk before the catalog refers to them. Bytes beyond count
+        are never read, so the existing records stay valid until the catalog
+        is updated. The hash chain is extended from the last block, the
+        statistics are updated with the new records.
+        """
+        hash = self.extend_hash(data, pagedir)
+        itemsize = np.dtype(self.idx_type).itemsize
+        filename = self.get_prefix(pagedir) + ".idx"
+        with open(filename, "r+b") as fh:
+            fh.seek(self.count * itemsize)
+            fh.write(np.ascontiguousarray(data.idx).tobytes())
+            fh.truncate()
+            fh.flush()
+            os.fsync(fh.fileno())
+        itemsize = type2dtype(self.rec_type).itemsize
+        filename = self.get_prefix(pagedir) + ".rec"
+        with open(filename, "r+b") as fh:
+            fh.seek(self.count * itemsize)
+            fh.write(np.ascontiguousarray(data.rec).tobytes())
+            fh.truncate()
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.end = data.idx[-1]
+        self.count += len(data)
+        self.size += data.get_size()
+        stats = combine_stats(self.get_stats(), rec_stats(data.rec))
+        self.stats = None if stats is None else json.dumps(stats)
+        self.hash = self.compute_hash(pagedir) if hash is None else hash
         self.write_meta(pagedir)
 
-    def delete(self, pagedir):
-        os.unlink(self.get_prefix(pagedir) + ".idx")
-        os.unlink(self.get_prefix(pagedir) + ".rec")
-        os.unlink(self.get_prefix(pagedir) + ".page")
+    def extend_hash(self, data, pagedir):
+        """
+        Return the hash of the page with data appended, reading only the
+        records of the last block if incomplete, or None without hash
+        """
+        if self.hash is None:
+            return None
+        state, prev = [bytes.fromhex(digest) for digest in self.hash.split(":")]
+        nblock = self.hash_block()
+        tail = self.count % nblock
+        idx, rec = data.idx, data.rec
+        if tail > 0:
+            # the last block is hashed again with the new records
+            state = prev
+            last = self.read_slice(pagedir, self.count - tail, self.count)
+            idx = np.concatenate([last.idx, idx])
+            rec = np.concatenate([last.rec, rec])
+        return format_hash(*chain_hash(state, idx, rec, nblock))
+
+    def delete(self, pagedir, missing_ok=False):
+        for extension in [".idx", ".rec", ".page"]:
+            try:
+                os.unlink(self.get_prefix(pagedir) + extension)
+            except FileNotFoundError:
+                if not missing_ok:
+                    raise
 
     def check_with_data(self, data):
         assert self.begin == data.idx[0]
@@ -110,6 +452,7 @@ class Page:
         assert self.count == len(data)
         assert self.size == data.get_size()
         assert self.idx_type == data.idx.dtype.str
+        assert self.rec_type == rec2type(data.rec)
         assert self.name == data.name
 
     def compare(self, page):
@@ -1,24 +1,173 @@
-import os, sqlite3
+import os, pickle, sqlite3, threading, weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import reduce
 from shutil import rmtree
 
+try:
+    import fcntl
+except ImportError:  # no advisory locks, e.g. on Windows
+    fcntl = None
+
 import numpy as np
 
-from .page import Page
+from .page import Page, type2dtype
 from .data import Data, DataSet
+from .cache import PageCache
+from .catalog import Catalog
+from .stats import field_stats, combine_field_stats, summary
+from .pyramid import bucket_range, downsample, level_name, to_level
+from .filters import where_can_match
+from .snapshot import Snapshot
 
 sqlite3.register_adapter(np.int64, int)
 
+# columns of the pages table, also stored in the history table
+page_columns = """pageid, name, begin, end, count, size, idx_type, rec_type,
+version, hash, stats"""
+
+
+def first_position(pos, offset, step):
+    """first position from pos selected by [offset::step]"""
+    if pos <= offset:
+        return offset
+    return pos + (offset - pos) % step
+
+
+def release_marker(marker, markerfile, lockfile):
+    """
+    Remove the dirty marker, unless other writers keep it open, and close it
+    under the writer lock. Run by close() or, for writers never closed, when
+    the PageStore is collected or the interpreter exits.
+    """
+    with open(lockfile, "a") as lock:
+        last = True
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                fcntl.flock(marker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                last = False
+        if last:
+            os.unlink(markerfile)
+        marker.close()
+
 
 class PageStore:
-    def __init__(self, pagedir, dbfile=None, max_page_size=10000000):
+    """
+    Collection of named data stored in pages.
+
+    Several processes can open the same pagedir: the catalog uses the sqlite
+    WAL journal so that readers do not block the writer, writers serialize
+    on an advisory lock on pagestore.lock and pages are replaced by new
+    files, so readers never see partially written pages.
+
+    With mode="r" the catalog is opened read-only, writes raise
+    PermissionError and the in-memory catalog and mmap reads are enabled
+    by default. If immutable is True, the store is assumed not to be
+    modified while open and all writers to be closed: sqlite skips locking
+    and the catalog is never reloaded.
+
+    Names can have a pyramid of downsampled levels, see set_pyramid(),
+    stored in a nested PageStore in pagedir/pyramid.
+
+    With cow=True (copy on write) replaced pages are kept and the history
+    table records the store version in which each page version was created
+    and deleted. snapshot() returns a consistent view of the current version
+    that can be read without locks while writes continue, gc() deletes the
+    page versions no longer visible to any snapshot.
+
+    Page files are written to temporary files renamed when complete. Writers
+    keep the pagestore.dirty marker while open, it is removed by close() or
+    when the store is collected or the interpreter exits. If a writer finds
+    the marker left by a writer that crashed, it runs recover() when opening.
+    """
+
+    # number of times a read is restarted when pages are replaced meanwhile
+    read_retries = 5
+
+    def __init__(
+        self,
+        pagedir,
+        dbfile=None,
+        max_page_size=10000000,
+        mmap=None,
+        cache_size=0,
+        buffer=None,
+        catalog=None,
+        mode="w",
+        immutable=False,
+        cow=False,
+        read_workers=4,
+    ):
+        if mode not in ("r", "w"):
+            raise ValueError(f"Invalid mode {mode!r}, must be 'r' or 'w'")
+        if immutable and mode != "r":
+            raise ValueError("immutable requires mode 'r'")
         self.pagedir = pagedir
-        os.makedirs(pagedir, exist_ok=True)
+        self.mode = mode
+        self.immutable = immutable
+        self.cow = cow
         if dbfile is None:
             dbfile = os.path.join(pagedir, "pagestore.db")
         self.dbfile = dbfile
-        self.db = sqlite3.connect(self.dbfile)
-        self.create_db()
+        self.lock = threading.RLock()
+        self.lockfile = os.path.join(pagedir, "pagestore.lock")
+        self.writer_lock = None
+        self.markerfile = os.path.join(pagedir, "pagestore.dirty")
+        self.marker = None
+        # store of the downsampled levels, opened when needed
+        self.pyramid = None
+        # threads reading pages in get_many, started when needed
+        self.read_workers = read_workers
+        self.read_executor = None
+        unclean = False
+        if mode == "r":
+            if buffer is not None:
+                raise ValueError("A write buffer requires mode 'w'")
+            flags = "immutable=1" if immutable else "mode=ro"
+            uri = f"file:{os.path.abspath(dbfile)}?{flags}"
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            os.makedirs(pagedir, exist_ok=True)
+            # the connection is shared with the background flush thread
+            self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.create_db()
+            unclean = self.open_marker()
+        self.data_version = self.get_data_version()
+        # optional in memory catalog, written through to the database
+        self.catalog = None
+        if catalog or (catalog is None and mode == "r"):
+            self.load_catalog()
         self.max_page_size = max_page_size
+        self.mmap = mode == "r" if mmap is None else mmap
+        # optional LRU cache of page data, cache_size in bytes
+        self.cache = PageCache(cache_size) if cache_size > 0 else None
+        # pages written and replaced in the current transaction
+        self.batch_depth = 0
+        self.pending_writes = []
+        self.pending_deletes = []
+        # pages extended in place in the current transaction, before the append
+        self.pending_appends = []
+        # last record per name, updated by writes, cleared by other processes
+        self.tails = {}
+        self.tails_version = self.data_version
+        # store version written by the current transaction, copy on write only
+        self.write_version = None
+        # report of the recovery run when opening after an unclean shutdown
+        self.recovery = None
+        if unclean:
+            self.recovery = self.recover()
+        if cow and mode == "w":
+            self.sync_history()
+        # optional WriteBuffer flushed to pages when full, on flush() or close()
+        self.buffer = buffer
+        self.flusher = None
+        if buffer is not None and buffer.max_age is not None:
+            self.stop_flusher = threading.Event()
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
 
     def __repr__(self):
         recall = self.count_records_all()
@@ -27,10 +176,136 @@ class PageStore:
             f"<Pagestore serving '{self.pagedir}': {recall} records in {pages} pages >"
         )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def check_writable(self):
+        if self.mode == "r":
+            raise PermissionError(f"PageStore '{self.pagedir}' is open read-only")
+
     def delete(self):
+        self.check_writable()
+        self.close(flush=False)
         os.unlink(self.dbfile)
+        for suffix in ["-wal", "-shm"]:
+            if os.path.exists(self.dbfile + suffix):
+                os.unlink(self.dbfile + suffix)
         rmtree(self.pagedir)
 
+    def close(self, flush=True):
+        """flush buffered data, if requested, and close the catalog"""
+        if self.flusher is not None:
+            self.stop_flusher.set()
+            self.flusher.join()
+            self.flusher = None
+        if self.buffer is not None:
+            if flush:
+                self.flush()
+            self.buffer.close()
+        if self.marker is not None:
+            self.close_marker()
+        if self.pyramid is not None:
+            self.pyramid.close()
+        if self.read_executor is not None:
+            self.read_executor.shutdown()
+            self.read_executor = None
+        if self.mode == "w":
+            # immutable readers ignore the WAL journal, move it in the database
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.close()
+
+    def acquire_writer(self):
+        """take the advisory lock that serializes writer processes"""
+        if fcntl is not None and self.writer_lock is None:
+            self.writer_lock = open(self.lockfile, "a")
+            fcntl.flock(self.writer_lock, fcntl.LOCK_EX)
+
+    def release_writer(self):
+        if self.writer_lock is not None:
+            fcntl.flock(self.writer_lock, fcntl.LOCK_UN)
+            self.writer_lock.close()
+            self.writer_lock = None
+
+    def open_marker(self):
+        """
+        Keep the dirty marker open while writing, shared with other writers.
+        Return True if the marker was left by a writer not closed cleanly.
+        """
+        self.acquire_writer()
+        try:
+            unclean = os.path.exists(self.markerfile)
+            self.marker = open(self.markerfile, "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.marker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # the marker belongs to writers still open
+                    unclean = False
+                fcntl.flock(self.marker, fcntl.LOCK_SH)
+        finally:
+            self.release_writer()
+        # the marker is released also if the store is never closed
+        self.marker_finalizer = weakref.finalize(
+            self, release_marker, self.marker, self.markerfile, self.lockfile
+        )
+        return unclean
+
+    def close_marker(self):
+        """remove the dirty marker if no other writer keeps it open"""
+        self.marker_finalizer()
+        self.marker = None
+
+    def get_data_version(self):
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self):
+        """
+        Reload in the in-memory catalog the names whose pages were changed
+        by another process
+        """
+        if self.catalog is None or self.immutable:
+            return
+        data_version = self.get_data_version()
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+        try:
+            sql = """SELECT name, serial FROM changes WHERE serial > ?"""
+            changes = self.db.execute(sql, (self.catalog_serial,)).fetchall()
+        except sqlite3.OperationalError:
+            # catalog created by an older version, without changes
+            self.load_catalog()
+            return
+        next_pageid = self.get_next_pageid()
+        self.catalog.next_pageid = max(self.catalog.next_pageid, next_pageid)
+        if len(changes) == 0:
+            return
+        sql = """select * FROM pages WHERE name IN
+               (SELECT name FROM changes WHERE serial > ?)"""
+        pages = [Page(*res) for res in self.db.execute(sql, (self.catalog_serial,))]
+        # names changed again meanwhile are loaded again at the next refresh
+        names = {name for name, serial in changes} | {page.name for page in pages}
+        self.catalog_serial = max(serial for name, serial in changes)
+        self.catalog.replace_names(names, pages)
+
+    def flush(self):
+        """store buffered data in pages in a single transaction"""
+        with self.lock:
+            if self.buffer is None or len(self.buffer) == 0:
+                return
+            with self.batch():
+                for name in self.buffer:
+                    self.write_data(self.buffer.get(name))
+            self.buffer.clear()
+
+    def flush_loop(self):
+        while not self.stop_flusher.wait(self.buffer.max_age / 2):
+            if self.buffer.is_due():
+                self.flush()
+
     #  Database operations
     def create_db(self):
         sql = """
@@ -41,37 +316,373 @@ class PageStore:
               end     NUMERIC,
               count   INTEGER,
               size    INTEGER,
-              idx_type STRING);
+              idx_type STRING,
+              rec_type STRING,
+              version INTEGER DEFAULT 0,
+              hash STRING,
+              stats STRING);
         CREATE INDEX IF NOT EXISTS page_index ON pages(pageid);
+        CREATE INDEX IF NOT EXISTS page_name_begin ON pages(name, begin);
+        CREATE INDEX IF NOT EXISTS page_name_end ON pages(name, end);
+        CREATE TABLE IF NOT EXISTS history(
+              pageid INTEGER,
+              name  STRING,
+              begin   NUMERIC,
+              end     NUMERIC,
+              count   INTEGER,
+              size    INTEGER,
+              idx_type STRING,
+              rec_type STRING,
+              version INTEGER,
+              created INTEGER,
+              deleted INTEGER,
+              hash STRING,
+              stats STRING);
+        CREATE INDEX IF NOT EXISTS history_pageid ON history(pageid, deleted);
+        CREATE INDEX IF NOT EXISTS history_name_begin ON history(name, begin);
+        CREATE TABLE IF NOT EXISTS snapshots(
+              snapshotid INTEGER PRIMARY KEY,
+              version INTEGER);
+        CREATE TABLE IF NOT EXISTS meta(
+              key STRING PRIMARY KEY,
+              value);
+        CREATE TABLE IF NOT EXISTS pyramids(
+              name STRING PRIMARY KEY,
+              width NUMERIC,
+              factor INTEGER,
+              levels INTEGER,
+              field STRING);
+        CREATE TABLE IF NOT EXISTS changes(
+              name STRING PRIMARY KEY,
+              serial INTEGER);
+        CREATE INDEX IF NOT EXISTS changes_serial ON changes(serial);
+        CREATE TRIGGER IF NOT EXISTS pages_insert AFTER INSERT ON pages BEGIN
+            INSERT OR REPLACE INTO changes VALUES
+            (NEW.name, (SELECT coalesce(max(serial), 0) + 1 FROM changes));
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_update AFTER UPDATE ON pages BEGIN
+            INSERT OR REPLACE INTO changes VALUES
+            (OLD.name, (SELECT coalesce(max(serial), 0) + 1 FROM changes));
+            INSERT OR REPLACE INTO changes VALUES
+            (NEW.name, (SELECT coalesce(max(serial), 0) + 1 FROM changes));
+        END;
+        CREATE TRIGGER IF NOT EXISTS pages_delete AFTER DELETE ON pages BEGIN
+            INSERT OR REPLACE INTO changes VALUES
+            (OLD.name, (SELECT coalesce(max(serial), 0) + 1 FROM changes));
+        END;
         """
         self.db.executescript(sql)
+        self.upgrade_db()
         self.db.commit()
 
-    def new_pageid(self):
-        sql = """SELECT max(pageid)+1 FROM pages"""
-        res = self.db.execute(sql).fetchone()[0]
-        if res is None:
+    def upgrade_db(self):
+        """add columns missing in catalogs created by older versions"""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pages)")]
+        if "rec_type" not in columns:
+            # NULL rec_type marks pickled records
+            self.db.execute("ALTER TABLE pages ADD COLUMN rec_type STRING")
+        if "version" not in columns:
+            self.db.execute("ALTER TABLE pages ADD COLUMN version INTEGER DEFAULT 0")
+        for column in ["hash", "stats"]:
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE pages ADD COLUMN {column} STRING")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(history)")]
+        for column in ["hash", "stats"]:
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE history ADD COLUMN {column} STRING")
+
+    def commit(self):
+        """
+        Commit the catalog unless a batch is in progress, then delete the
+        files of the pages that are no longer referenced
+        """
+        if self.batch_depth > 0:
+            return
+        if self.write_version is not None:
+            sql = """INSERT OR REPLACE INTO meta VALUES ('version', ?)"""
+            self.db.execute(sql, (self.write_version,))
+            self.write_version = None
+        self.db.commit()
+        if self.catalog is not None and self.writer_lock is not None:
+            # the catalog is up to date, refreshed when the writer lock was taken
+            self.catalog_serial = self.get_catalog_serial()
+        if self.cow:
+            # keep replaced pages for snapshots, unless never committed
+            written = {(page.pageid, page.version) for page in self.pending_writes}
+            deletes = self.pending_deletes
+            self.pending_deletes = [
+                page for page in deletes if (page.pageid, page.version) in written
+            ]
+        for page in self.pending_deletes:
+            page.delete(self.pagedir, missing_ok=True)
+        self.pending_writes = []
+        self.pending_deletes = []
+        self.pending_appends = []
+
+    def rollback(self):
+        """discard catalog changes and the files written since the last commit"""
+        self.db.rollback()
+        self.write_version = None
+        for page in self.pending_writes:
+            page.delete(self.pagedir, missing_ok=True)
+        # truncate appended pages, the earliest append restores the committed page
+        for page in reversed(self.pending_appends):
+            page.repair(self.pagedir)
+        self.pending_writes = []
+        self.pending_deletes = []
+        self.pending_appends = []
+        self.tails.clear()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.catalog is not None:
+            self.load_catalog()
+
+    def get_catalog_serial(self):
+        """last change of the pages table, 0 if changes are not recorded"""
+        try:
+            sql = """SELECT coalesce(max(serial), 0) FROM changes"""
+            return self.db.execute(sql).fetchone()[0]
+        except sqlite3.OperationalError:
             return 0
+
+    def load_catalog(self):
+        # changes committed meanwhile are loaded again by refresh
+        self.catalog_serial = self.get_catalog_serial()
+        sql = """select * FROM pages"""
+        self.catalog = Catalog(Page(*res) for res in self.db.execute(sql))
+        self.catalog.next_pageid = self.get_next_pageid()
+
+    @contextmanager
+    def batch(self):
+        """
+        Run catalog operations in a single transaction committed at the end.
+
+        Pages are never rewritten in place: new files are written before the
+        catalog refers to them and old files are deleted after the commit,
+        so the committed catalog always points at complete pages.
+        """
+        self.check_writable()
+        with self.lock:
+            if self.batch_depth == 0:
+                self.acquire_writer()
+                self.refresh()
+            self.batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.rollback()
+                    self.release_writer()
+                raise
+            self.batch_depth -= 1
+            self.commit()
+            if self.batch_depth == 0:
+                self.release_writer()
+
+    def new_pageid(self):
+        """
+        Allocate a pageid from a counter that only grows, so that the files
+        of deleted pages, still opened by readers, never hold other pages
+        """
+        self.check_writable()
+        if self.catalog is not None:
+            pageid = self.catalog.new_pageid()
         else:
-            return res
+            pageid = self.get_next_pageid()
+        sql = """INSERT OR REPLACE INTO meta VALUES ('next_pageid', ?)"""
+        self.db.execute(sql, (pageid + 1,))
+        self.commit()
+        return pageid
+
+    def get_next_pageid(self):
+        """first pageid not allocated by the counter nor used by any page"""
+        sql = """SELECT value FROM meta WHERE key = 'next_pageid'"""
+        res = self.db.execute(sql).fetchone()
+        counter = 0 if res is None else res[0]
+        return max(counter, self.new_pageid_history())
+
+    def new_pageid_history(self):
+        """pageid never used, also by the page versions kept for snapshots"""
+        sql = """SELECT max(pageid)+1 FROM
+               (SELECT pageid FROM pages UNION ALL SELECT pageid FROM history)"""
+        res = self.db.execute(sql).fetchone()[0]
+        return 0 if res is None else res
 
     def insert_page(self, page):
+        self.check_writable()
         sql = """INSERT OR REPLACE INTO pages VALUES
-               (?,?,?,?,?,?,?)"""
+               (?,?,?,?,?,?,?,?,?,?,?)"""
         self.db.execute(sql, page.to_list())
-        self.db.commit()
+        if self.cow:
+            self.delete_history(page.pageid)
+            sql = f"""INSERT INTO history({page_columns}, created)
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"""
+            self.db.execute(sql, (*page.to_list(), self.get_write_version()))
+        if self.catalog is not None:
+            self.catalog.insert(page)
+        self.commit()
 
     def remove_page(self, pageid):
         """remove page from database"""
+        self.check_writable()
         sql = """DELETE FROM pages WHERE pageid=?"""
         self.db.execute(sql, (pageid,))
-        self.db.commit()
+        if self.cow:
+            self.delete_history(pageid)
+        if self.catalog is not None:
+            self.catalog.remove(pageid)
+        self.commit()
+
+    # Copy on write history
+    def get_version(self):
+        """last committed store version"""
+        sql = """SELECT value FROM meta WHERE key = 'version'"""
+        res = self.db.execute(sql).fetchone()
+        return 0 if res is None else res[0]
+
+    def get_write_version(self):
+        """store version of the changes of the current transaction"""
+        if self.write_version is None:
+            self.write_version = self.get_version() + 1
+        return self.write_version
+
+    def delete_history(self, pageid):
+        """mark the current version of pageid as deleted in the write version"""
+        version = self.get_write_version()
+        # versions created in the same transaction have never been visible
+        sql = """DELETE FROM history
+               WHERE pageid = ? AND deleted IS NULL AND created = ?"""
+        self.db.execute(sql, (pageid, version))
+        sql = """UPDATE history SET deleted = ?
+               WHERE pageid = ? AND deleted IS NULL"""
+        self.db.execute(sql, (version, pageid))
+
+    def sync_history(self):
+        """record in the history the pages changed while not in copy on write"""
+        with self.batch():
+            sql = """SELECT count(*) FROM history
+                   WHERE deleted IS NULL AND (pageid, version, count) NOT IN
+                   (SELECT pageid, version, count FROM pages)"""
+            stale = self.db.execute(sql).fetchone()[0]
+            sql = """SELECT count(*) FROM pages
+                   WHERE (pageid, version, count) NOT IN
+                   (SELECT pageid, version, count FROM history
+                    WHERE deleted IS NULL)"""
+            missing = self.db.execute(sql).fetchone()[0]
+            if stale == 0 and missing == 0:
+                return
+            version = self.get_write_version()
+            sql = """UPDATE history SET deleted = ?
+                   WHERE deleted IS NULL AND (pageid, version, count) NOT IN
+                   (SELECT pageid, version, count FROM pages)"""
+            self.db.execute(sql, (version,))
+            sql = f"""INSERT INTO history({page_columns}, created)
+                   SELECT {page_columns}, ? FROM pages
+                   WHERE (pageid, version, count) NOT IN
+                   (SELECT pageid, version, count FROM history
+                    WHERE deleted IS NULL)"""
+            self.db.execute(sql, (version,))
+
+    def get_history_pages(self, version, name, idx1=-np.infty, idx2=np.infty):
+        """get pages of name visible in version with end >= idx1 and begin <= idx2"""
+        sql = f"""SELECT {page_columns} FROM history
+               WHERE name = ? AND end >= ? AND begin <= ?
+               AND created <= ? AND (deleted IS NULL OR deleted > ?)
+               ORDER BY begin"""
+        args = (name, idx1, idx2, version, version)
+        return [Page(*res) for res in self.db.execute(sql, args)]
+
+    def search_history(self, version, pattern="%"):
+        sql = """SELECT DISTINCT name FROM history WHERE name LIKE ?
+               AND created <= ? AND (deleted IS NULL OR deleted > ?)
+               ORDER BY name"""
+        args = (pattern, version, version)
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def snapshot(self):
+        """
+        Return a Snapshot of the last committed version. The snapshot is
+        registered in the catalog, so that gc() keeps its pages, until it is
+        closed. Immutable stores, that have no writers, do not register it.
+        """
+        if not self.cow:
+            raise ValueError("Snapshots require cow=True")
+        if self.immutable:
+            return Snapshot(self, self.get_version())
+        with self.lock, self.snapshot_db() as db:
+            sql = """INSERT INTO snapshots(version)
+                   SELECT coalesce(max(value), 0) FROM meta WHERE key = 'version'"""
+            snapshotid = db.execute(sql).lastrowid
+            sql = """SELECT version FROM snapshots WHERE snapshotid = ?"""
+            version = db.execute(sql, (snapshotid,)).fetchone()[0]
+        return Snapshot(self, version, snapshotid)
+
+    def release_snapshot(self, snapshotid):
+        with self.lock, self.snapshot_db() as db:
+            sql = """DELETE FROM snapshots WHERE snapshotid = ?"""
+            db.execute(sql, (snapshotid,))
+
+    @contextmanager
+    def snapshot_db(self):
+        """
+        Connection registering snapshots, read-only stores open a writable
+        one, so that the snapshots of readers are kept by the writer's gc()
+        """
+        if self.mode == "w":
+            yield self.db
+            self.commit()
+            return
+        db = sqlite3.connect(self.dbfile)
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def gc(self):
+        """
+        Delete the page versions not visible in the current version nor in
+        any registered snapshot. Return the number of page versions deleted.
+        """
+        with self.lock, self.batch():
+            sql = """SELECT min(version) FROM snapshots"""
+            oldest = self.db.execute(sql).fetchone()[0]
+            if oldest is None:
+                oldest = self.get_version()
+            sql = f"""SELECT {page_columns} FROM history
+                   WHERE deleted IS NOT NULL AND deleted <= ?"""
+            pages = [Page(*res) for res in self.db.execute(sql, (oldest,))]
+            sql = """DELETE FROM history
+                   WHERE deleted IS NOT NULL AND deleted <= ?"""
+            self.db.execute(sql, (oldest,))
+            # files can be still used if pages were changed without copy on write
+            sql = """SELECT pageid, version FROM pages"""
+            current = set(self.db.execute(sql))
+        for page in pages:
+            if (page.pageid, page.version) not in current:
+                self.invalidate_page(page)
+                page.delete(self.pagedir, missing_ok=True)
+        return len(pages)
 
     def delete_page(self, page):
-        """remove page from database and deleta page data"""
+        """remove page from database and delete page data after commit"""
+        self.invalidate_page(page)
+        self.pending_deletes.append(page)
         self.remove_page(page.pageid)
-        page.delete(self.pagedir)
-        self.db.commit()
+
+    def delete_name(self, name):
+        """delete all pages of name and the levels of its pyramid, if any"""
+        self.tails.pop(name, None)
+        with self.batch():
+            for page in self.get_pages(name):
+                self.delete_page(page)
+            config = self.get_pyramid(name)
+            if config is not None:
+                width, factor, levels, field = config
+                store = self.get_pyramid_store()
+                for level in range(1, levels + 1):
+                    store.delete_name(level_name(name, level))
 
     def gen_pages(self, name):
         sql = """select * FROM pages WHERE name = ?
@@ -79,41 +690,124 @@ class PageStore:
         return (Page(*res) for res in self.db.execute(sql, (name,)))
 
     def get_pages(self, name):
+        if self.catalog is not None:
+            return self.catalog.get_pages(name)
         return list(self.gen_pages(name))
 
     def get_page_before(self, name, idx):
         """get pages with begin before ii included"""
+        if self.catalog is not None:
+            return self.catalog.get_page_before(name, idx)
         sql = """select * FROM pages WHERE  name = ? AND begin <= ?
                ORDER BY begin DESC LIMIT 1"""
         res = self.db.execute(sql, (name, idx)).fetchone()
         if res is not None:
             return Page(*res)
 
+    def get_page_prev(self, name, idx):
+        """get pages with begin before ii excluded"""
+        if self.catalog is not None:
+            return self.catalog.get_page_prev(name, idx)
+        sql = """select * FROM pages WHERE  name = ? AND begin < ?
+               ORDER BY begin DESC LIMIT 1"""
+        res = self.db.execute(sql, (name, idx)).fetchone()
+        if res is not None:
+            return Page(*res)
+
     def get_page_after(self, name, idx):
         """get pages with begin after ii excluded"""
+        if self.catalog is not None:
+            return self.catalog.get_page_after(name, idx)
         sql = """select * FROM pages WHERE  name = ? AND begin > ?
                ORDER BY begin LIMIT 1"""
         res = self.db.execute(sql, (name, idx)).fetchone()
         if res is not None:
             return Page(*res)
 
+    def get_last_page(self, name):
+        if self.catalog is not None:
+            return self.catalog.get_last_page(name)
+        sql = """select * FROM pages WHERE  name = ?
+               ORDER BY begin DESC LIMIT 1"""
+        res = self.db.execute(sql, (name,)).fetchone()
+        if res is not None:
+            return Page(*res)
+
+    def get_pages_covering(self, name, idx1, idx2):
+        """
+        get pages that receive data between idx1 and idx2, each page covers
+        from its begin to the begin of the next page, the first page covers
+        also everything before
+        """
+        pages = self.get_pages_begin_between(name, idx1, idx2)
+        page_before = self.get_page_before(name, idx1)
+        if page_before is not None:
+            pages.insert(0, page_before)
+        elif len(pages) == 0:
+            page_after = self.get_page_after(name, idx1)
+            if page_after is not None:
+                pages.append(page_after)
+        return pages
+
+    def get_pages_begin_between(self, name, idx1, idx2):
+        """get pages with idx1 < begin <= idx2"""
+        if self.catalog is not None:
+            return self.catalog.get_pages_begin_between(name, idx1, idx2)
+        sql = """select * FROM pages WHERE  name = ? AND begin > ? AND begin <= ?
+               ORDER BY begin"""
+        return [Page(*res) for res in self.db.execute(sql, (name, idx1, idx2))]
+
     def get_pages_between(self, name, idx1, idx2):
-        """get pages with begin before ii included"""
+        """get pages with end >= idx1 and begin <= idx2"""
+        if self.catalog is not None:
+            return self.catalog.get_pages_between(name, idx1, idx2)
         sql = """select * FROM pages
                WHERE  name = ? AND end >= ? AND begin <= ?
                ORDER BY begin"""
         return [Page(*res) for res in self.db.execute(sql, (name, idx1, idx2))]
 
+    def get_pages_ranges(self, ranges):
+        """
+        get the pages between idx1 and idx2 of each name of the dict ranges
+        of name: (idx1, idx2)
+        """
+        if self.catalog is not None:
+            return {
+                name: self.catalog.get_pages_between(name, idx1, idx2)
+                for name, (idx1, idx2) in ranges.items()
+            }
+        res = {name: [] for name in ranges}
+        items = list(ranges.items())
+        # at most 999 parameters per query in older sqlite versions
+        for ii in range(0, len(items), 333):
+            chunk = items[ii:ii + 333]
+            values = ",".join(["(?,?,?)"] * len(chunk))
+            sql = f"""WITH ranges(name, idx1, idx2) AS (VALUES {values})
+                   SELECT pages.* FROM pages JOIN ranges USING (name)
+                   WHERE end >= idx1 AND begin <= idx2
+                   ORDER BY begin"""
+            args = [arg for name, (idx1, idx2) in chunk for arg in (name, idx1, idx2)]
+            for row in self.db.execute(sql, args):
+                page = Page(*row)
+                res[page.name].append(page)
+        return res
+
     def count_pages(self, name):
+        if self.catalog is not None:
+            return self.catalog.count_pages(name)
         sql = """select count(*) FROM pages WHERE name = ?"""
         return self.db.execute(sql, (name,)).fetchone()[0]
 
     def count_records(self, name):
+        if self.catalog is not None:
+            return self.catalog.count_records(name)
         sql = """select sum(count) FROM pages WHERE name = ?"""
         res = self.db.execute(sql, (name,)).fetchone()[0]
         return 0 if res is None else res
 
     def get_page(self, pageid):
+        if self.catalog is not None:
+            return self.catalog.get_page(pageid)
         sql = """select * FROM pages WHERE pageid = ?"""
         res = self.db.execute(sql, (pageid,)).fetchone()
         if res is not None:
@@ -139,131 +833,1081 @@ class PageStore:
 
     #  End Database operations
 
-    def new_page(self, pageid, data):
-        """store data in pageid"""
-        page = Page.from_data(pageid, data)
+    # Downsampled levels
+    def set_pyramid(self, name, width, factor=10, levels=4, field=None):
+        """
+        Maintain for name levels of min, max, mean and count of the records,
+        or of field for structured records, in buckets of width, width*factor,
+        width*factor**2, ... The levels are built from the stored data and
+        then updated by each write.
+        """
+        self.check_writable()
+        with self.lock, self.batch():
+            sql = """INSERT OR REPLACE INTO pyramids VALUES (?,?,?,?,?)"""
+            self.db.execute(sql, (name, width, factor, levels, field))
+            store = self.get_pyramid_store()
+            for level in range(1, levels + 1):
+                store.delete_name(level_name(name, level))
+            pages = self.get_pages(name)
+            if len(pages) > 0:
+                self.update_pyramid(name, pages[0].begin, pages[-1].end)
+
+    def get_pyramid(self, name):
+        """return width, factor, levels and field of the pyramid of name or None"""
+        sql = """SELECT width, factor, levels, field FROM pyramids WHERE name = ?"""
+        return self.db.execute(sql, (name,)).fetchone()
+
+    def get_pyramid_store(self):
+        if self.pyramid is None:
+            self.pyramid = PageStore(
+                os.path.join(self.pagedir, "pyramid"),
+                max_page_size=self.max_page_size,
+                mode=self.mode,
+                immutable=self.immutable,
+            )
+        return self.pyramid
+
+    def update_pyramid(self, name, idx1, idx2):
+        """recompute the buckets of the levels of name overlapping idx1, idx2"""
+        config = self.get_pyramid(name)
+        if config is None:
+            return
+        width, factor, levels, field = config
+        store = self.get_pyramid_store()
+        for level in range(1, levels + 1):
+            level_width = width * factor ** (level - 1)
+            idx1, idx2 = bucket_range(idx1, idx2, level_width)
+            if level == 1:
+                data = self.get_data(name, idx1, idx2, mmap=False)
+                if data is not None:
+                    data = to_level(data, field)
+            else:
+                data = store.get_data(level_name(name, level - 1), idx1, idx2)
+            if data is None:
+                return
+            # the bucket starting at idx2 is not affected
+            data = data.cut_idx(np.searchsorted(data.idx, idx2, side="left"))[0]
+            if len(data) > 0:
+                store.store_data(downsample(data, level_width, level_name(name, level)))
+
+    def choose_level(self, name, idx1, idx2, max_points):
+        """
+        Return the finest level of name with at most max_points buckets
+        between idx1 and idx2, or 0 if the records are at most max_points
+        """
+        config = self.get_pyramid(name)
+        if config is None:
+            return 0
+        pages = self.get_pages_between(name, idx1, idx2)
+        # only the pages at the edges are searched
+        slices = [page.locate(self.pagedir, idx1, idx2) for page in pages]
+        if sum(ii2 - ii1 for ii1, ii2 in slices) <= max_points:
+            return 0
+        width, factor, levels, field = config
+        idx1 = max(idx1, pages[0].begin)
+        idx2 = min(idx2, pages[-1].end)
+        for level in range(1, levels + 1):
+            if (idx2 - idx1) / (width * factor ** (level - 1)) < max_points:
+                return level
+        return levels
+
+    def get_level_data(self, name, level, idx1=-np.infty, idx2=np.infty, mmap=None):
+        """return the buckets of level of name overlapping idx1, idx2"""
+        width, factor, levels, field = self.get_pyramid(name)
+        if np.isfinite(idx1):
+            idx1, end = bucket_range(idx1, idx1, width * factor ** (level - 1))
+        store = self.get_pyramid_store()
+        data = store.get_data(level_name(name, level), idx1, idx2, mmap)
+        if data is not None:
+            data.name = name
+        return data
+
+    # Page data operations
+    def read_page(self, page, mmap=None):
+        """
+        Read page data, using the page cache if enabled.
+        Pages are never mapped when mmap is False, that is required
+        when the page is going to be rewritten.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        if self.cache is not None:
+            res = self.cache.get(page.cache_key())
+            if res is not None:
+                return Data(*res, page.name)
+        data = page.read(self.pagedir, mmap)
+        if self.cache is not None and not mmap:
+            self.cache.put(page.cache_key(), data.idx, data.rec)
+        return data
+
+    def read_block(self, page, idx1, idx2, mmap=None):
+        """
+        Read page data between idx1 and idx2. Without cache and mmap, only
+        the records in the range are read after a binary search of the index.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        covered = page.begin >= idx1 and page.end <= idx2
+        if self.cache is None and not mmap and not covered:
+            return page.read_range(self.pagedir, idx1, idx2)
+        return self.read_page(page, mmap).trim(idx1, idx2)
+
+    def write_page(self, pageid, data, old=None):
+        """
+        Write data in pageid.
+        If old page is given, new files are written with a new version
+        and the old ones are deleted after commit.
+        """
+        self.check_writable()
+        if old is not None:
+            version = old.version + 1
+        elif self.cow:
+            # pageid might have versions kept for snapshots
+            sql = """SELECT coalesce(max(version)+1, 0) FROM history WHERE pageid = ?"""
+            version = self.db.execute(sql, (pageid,)).fetchone()[0]
+        else:
+            version = 0
+        page = Page.from_data(pageid, data, version)
         page.write(data, self.pagedir)
+        self.pending_writes.append(page)
+        if old is not None:
+            self.invalidate_page(old)
+            self.pending_deletes.append(old)
         self.insert_page(page)
+        return page
+
+    def invalidate_page(self, page):
+        if self.cache is not None:
+            self.cache.invalidate(page.cache_key())
+
+    def cache_info(self):
+        """return hits, misses and size of the page cache"""
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def new_page(self, pageid, data):
+        """store data in pageid"""
+        self.write_page(pageid, data, self.get_page(pageid))
 
     def merge_page_data(self, page, data):
-        data, replace = data.merge(page.read(self.pagedir))
+        """merge data in page, data replaces records with the same idx"""
+        data, replace = self.read_page(page, mmap=False).merge(data)
         # pageid is recycled
-        page = Page.from_data(page.pageid, data)
-        page.write(data, self.pagedir)
-        self.insert_page(page)
+        page = self.write_page(page.pageid, data, page)
         return page.pageid
 
+    def append_page(self, page, data):
+        """
+        Append data strictly after the end of the last page of a name,
+        filling the page up to max_page_size and opening new pages for the rest
+        """
+        rowsize = data.rec[:1].nbytes
+        room = max(self.max_page_size - page.size, 0)
+        head, data = data.cut_idx(room // rowsize if rowsize > 0 else len(data))
+        if len(head) > 0:
+            self.invalidate_page(page)
+            self.pending_appends.append(Page(*page.to_list()))
+            page.append(head, self.pagedir)
+            self.insert_page(page)
+        nfull = max(self.max_page_size // rowsize, 1) if rowsize > 0 else len(data)
+        while len(data) > 0:
+            head, data = data.cut_idx(nfull)
+            self.new_page(self.new_pageid(), head)
+
     def merge_page_page(self, page1, page2):
-        data1 = page1.read(self.pagedir)
-        data2 = page2.read(self.pagedir)
+        data1 = self.read_page(page1, mmap=False)
+        data2 = self.read_page(page2, mmap=False)
         data, replace = data1.merge(data2)
         # pageid of page1 is recycled, page2 dropped
-        page = Page.from_data(page1.pageid, data)
-        page.write(data, self.pagedir)
-        self.insert_page(page)
+        page = self.write_page(page1.pageid, data, page1)
         self.delete_page(page2)
         return page.pageid
 
-    def split_pages(self, name):
-        for page in self.gen_pages(name):
-            if page.size > self.max_page_size:
-                data = page.read(self.pagedir)
-                left, right = data.cut_nbytes(self.max_page_size)
-                # recycle page.pageid
-                self.new_page(page.pageid, left)
-                # get new pageid
-                self.new_page(self.new_pageid(), right)
-
-    def join_pages(self, name):
-        pages = list(self.gen_pages(name))
-        for ii in range(len(pages)):
-            for jj in range(1, len(pages) - ii):
-                if pages[ii].size + pages[ii + jj].size < self.max_page_size:
-                    self.merge_page_page(pages[ii], pages[ii + jj])
-                else:
-                    break
+    def split_page(self, page):
+        """
+        Split page in as many pages as needed to fit max_page_size in a
+        single pass, the first part keeps the pageid. Return the new pages.
+        """
+        if page.size <= self.max_page_size:
+            return [page]
+        data = self.read_page(page, mmap=False)
+        rowsize = data.rec[:1].nbytes
+        count = max(self.max_page_size // rowsize, 1) if rowsize > 0 else len(data)
+        parts = data.split(data.idx[count::count])
+        pages = [self.write_page(page.pageid, parts[0], page)]
+        for part in parts[1:]:
+            pages.append(self.write_page(self.new_pageid(), part))
+        return pages
+
+    def join_page(self, page):
+        """
+        Join page with the previous and next pages as long as the result
+        fits in max_page_size. Return the joined page.
+        """
+        prev = self.get_page_prev(page.name, page.begin)
+        if prev is not None and prev.size + page.size < self.max_page_size:
+            page = self.get_page(self.merge_page_page(prev, page))
+        while True:
+            page_next = self.get_page_after(page.name, page.begin)
+            if page_next is None or page.size + page_next.size >= self.max_page_size:
+                return page
+            page = self.get_page(self.merge_page_page(page, page_next))
+
+    def split_pages(self, name, pageids=None):
+        """
+        Split pages larger than max_page_size, only pageids if given.
+        Return the resulting pages.
+        """
+        if pageids is None:
+            pages = self.get_pages(name)
+        else:
+            pages = [self.get_page(pageid) for pageid in pageids]
+        res = []
+        for page in pages:
+            if page is not None:
+                res.extend(self.split_page(page))
+        return res
 
-    def rebalance(self, name):
-        self.split_pages(name)
-        self.join_pages(name)
+    def join_pages(self, name, pageids=None):
+        """join consecutive pages, only pageids and their neighbours if given"""
+        if pageids is None:
+            pages = self.get_pages(name)
+        else:
+            pages = [self.get_page(pageid) for pageid in pageids]
+            pages = sorted(filter(None, pages), key=lambda page: page.begin)
+        for page in pages:
+            # skip pages already joined to the previous ones
+            page = self.get_page(page.pageid)
+            if page is not None:
+                self.join_page(page)
+
+    def rebalance(self, name, pageids=None):
+        """split and join pages, only the pageids and their neighbours if given"""
+        pages = self.split_pages(name, pageids)
+        if pageids is not None:
+            pageids = [page.pageid for page in pages]
+        self.join_pages(name, pageids)
 
     def store_data(self, data):
+        """
+        Store data in pages, or in the write buffer if enabled,
+        catalog changes are committed once at the end
+        """
+        self.check_writable()
         # make sure it is sorted
         data.sort()
-        name = data.name
-        if self.count_pages(name) == 0:
-            # first page in db
-            self.new_page(self.new_pageid(), data)
-            return
-        # find relevant pages
-        # each page convers the regions from the beginning of the page to
-        # the beginning of the next page excluded
-        # with the exception of the first page that covers everything before and
-        # and the last page that covers after
-        while len(data) > 0:
-            # find the page before and after the beginnig of data
-            # there must at least be one page
-            page_before = self.get_page_before(name, data.begin())
-            page_after = self.get_page_after(name, data.begin())
-            if page_before is None:
-                # page_after must exists
-                # data before page.begin is pre-pended to page and the rest re-submitted
-                curr, data = data.cut_lt(page_after.begin)
-                self.merge_page_data(page_after, curr)
+        with self.lock:
+            if self.buffer is None:
+                self.write_data(data)
             else:
-                # a page before exists
-                # if a page after exists data belonging to page_before is used and
-                # the rest resubmitted otherwise everything is used
-                if page_after is not None:
-                    curr, data = data.cut_lt(page_after.begin)
-                else:
-                    curr = data
-                    data = []
-                self.merge_page_data(page_before, curr)
-        # by merging some pages might have grown too much,
-        # rebalance split and rejoin pages
-        self.rebalance(name)
+                self.buffer.store_data(data)
+                if self.buffer.is_full():
+                    self.flush()
+            self.update_tail(data)
+
+    def write_data(self, data):
+        """write sorted data in pages and update the pyramid of name, if any"""
+        with self.batch():
+            self.write_pages(data)
+            self.update_pyramid(data.name, data.begin(), data.end())
+
+    def write_pages(self, data):
+        with self.batch():
+            name = data.name
+            last = self.get_last_page(name)
+            if last is not None and not self.cow and last.can_append(data):
+                # fast path for data strictly after the stored one
+                self.append_page(last, data)
+                return
+            # each page covers the region from its begin to the begin of the
+            # next page excluded, the first page covers also everything before
+            pages = self.get_pages_covering(name, data.begin(), data.end())
+            pageids = set()
+            if len(pages) == 0:
+                # first page in db
+                pageid = self.new_pageid()
+                self.new_page(pageid, data)
+                pageids.add(pageid)
+            # partition data among pages in a single pass
+            parts = data.split([page.begin for page in pages[1:]])
+            for page, part in zip(pages, parts):
+                if len(part) > 0:
+                    pageids.add(self.merge_page_data(page, part))
+            # by merging some pages might have grown too much,
+            # rebalance split and rejoin the pages that have been modified
+            self.rebalance(name, pageids)
 
     def store(self, dataset):
-        for name, data in dataset.items():
-            if Data.is_data(data):
-                self.store_data(data)
-            else:
-                idx, rec = data
-                self.store_data(Data(idx, rec, name))
+        """store a dataset or a dict of data, committed once at the end"""
+        with self.lock, self.batch():
+            for name, data in dataset.items():
+                if Data.is_data(data):
+                    self.store_data(data)
+                else:
+                    idx, rec = data
+                    self.store_data(Data(idx, rec, name))
 
     # Extraction methods
-    def get_data(self, name, idx1=-np.infty, idx2=np.infty):
-        pages = self.get_pages_between(name, idx1, idx2)
+    def iter_data(self, name, idx1=-np.infty, idx2=np.infty, chunk=None, mmap=None):
+        """
+        Yield data of name between idx1 and idx2 included, one page at a time
+        or, if chunk is given, in pieces of chunk records.
+        Buffered data is merged in the page it belongs to.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        datalist = self.gen_range_data(name, idx1, idx2, mmap)
+        yield from self.gen_chunks(name, datalist, chunk)
 
-        data = None
-        for page in pages:
-            if data is None:
-                data = page.read(self.pagedir)
-            else:
-                data.append(page.read(self.pagedir))
+    @staticmethod
+    def gen_chunks(name, datalist, chunk=None):
+        """yield data from datalist in pieces of chunk records, if given"""
+        if chunk is None:
+            yield from datalist
+            return
+        pending = []
+        count = 0
+        for data in datalist:
+            pending.append(data)
+            count += len(data)
+            if count >= chunk:
+                data = Data.concatenate_list(pending)
+                for ii in range(0, count - chunk + 1, chunk):
+                    jj = ii + chunk
+                    yield Data(data.idx[ii:jj], data.rec[ii:jj], name)
+                rest = count % chunk
+                pending = [data.cut_idx(count - rest)[1]] if rest > 0 else []
+                count = rest
+        if count > 0:
+            yield Data.concatenate_list(pending)
+
+    def get_range(self, name, idx1, idx2):
+        """
+        Return the pages between idx1 and idx2 and, if data is buffered,
+        the buffered data in the range split among them
+        """
+        return self.get_ranges({name: (idx1, idx2)})[name]
 
-        return data.trim(idx1, idx2)
+    def get_ranges(self, ranges):
+        """
+        Return pages and buffered parts, as get_range, of each name of the
+        dict ranges of name: (idx1, idx2), looked up in one catalog query
+        """
+        with self.lock:
+            self.refresh()
+            pages = self.get_pages_ranges(ranges)
+            buffered = {}
+            if self.buffer is not None:
+                buffered = {name: self.buffer.get(name) for name in ranges}
+        res = {}
+        for name, (idx1, idx2) in ranges.items():
+            parts = None
+            if buffered.get(name) is not None:
+                data = buffered[name].trim(idx1, idx2)
+                if len(pages[name]) == 0:
+                    parts = [data]
+                else:
+                    parts = data.split([page.begin for page in pages[name][1:]])
+            res[name] = pages[name], parts
+        return res
+
+    def gen_range_data(self, name, idx1, idx2, mmap, pages=None, parts=None):
+        """
+        Yield trimmed page data between idx1 and idx2, restarting after the
+        last yielded record if pages are replaced by a writer meanwhile.
+        Pages and buffered parts from get_range can be given for the first try.
+        """
+        last = None
+        for attempt in range(self.read_retries):
+            if pages is None:
+                pages, parts = self.get_range(name, idx1, idx2)
+            try:
+                for data in self.gen_page_data(pages, idx1, idx2, mmap, parts):
+                    if last is not None:
+                        icut = np.searchsorted(data.idx, last, side="right")
+                        data = data.cut_idx(icut)[1]
+                    if len(data) > 0:
+                        last = data.end()
+                        yield data
+                return
+            except FileNotFoundError:
+                if attempt == self.read_retries - 1:
+                    raise
+                if last is not None:
+                    idx1 = last
+                pages = None
+
+    def gen_page_data(self, pages, idx1, idx2, mmap, parts=None):
+        """yield trimmed page data merged with the buffered parts if given"""
+        if len(pages) == 0 and parts is not None and len(parts[0]) > 0:
+            yield parts[0]
+        for ii, page in enumerate(pages):
+            data = self.read_block(page, idx1, idx2, mmap)
+            if parts is not None and len(parts[ii]) > 0:
+                if len(data) == 0:
+                    data = parts[ii]
+                else:
+                    data, replaced = data.merge(parts[ii])
+            if len(data) > 0:
+                yield data
+
+    def get_data(
+        self, name, idx1=-np.infty, idx2=np.infty, mmap=None, max_points=None
+    ):
+        """
+        Return data of name between idx1 and idx2 included.
+
+        The result is allocated once using the page counts and each page
+        slice is read directly in place. If mmap is True (default self.mmap)
+        a range inside a single page is returned as a read-only view.
+
+        If max_points is given and name has a pyramid, the records of the
+        finest level with at most max_points buckets are returned
+        when the range holds more than max_points records.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        if max_points is not None:
+            level = self.choose_level(name, idx1, idx2, max_points)
+            if level > 0:
+                return self.get_level_data(name, level, idx1, idx2, mmap)
+        for attempt in range(self.read_retries):
+            pages, parts = self.get_range(name, idx1, idx2)
+            if not self.can_read_range(pages, mmap):
+                datalist = self.gen_range_data(name, idx1, idx2, mmap, pages, parts)
+                return self.concatenate(datalist)
+            try:
+                return self.read_range(name, pages, parts, idx1, idx2)
+            except FileNotFoundError:
+                # pages replaced by a writer, read them again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def can_read_range(self, pages, mmap):
+        """
+        Return True if pages can be read in a single preallocated array,
+        cached pages, views, mixed types and pickled records are instead
+        concatenated from the page slices
+        """
+        types = {(page.idx_type, page.rec_type) for page in pages}
+        return not (
+            self.cache is not None
+            or (mmap and len(pages) == 1)
+            or len(types) > 1
+            or any(page.rec_type is None for page in pages)
+        )
+
+    @staticmethod
+    def concatenate(datalist):
+        datalist = list(datalist)
+        if len(datalist) == 0:
+            return None
+        return Data.concatenate_list(datalist)
+
+    def read_range(self, name, pages, parts, idx1, idx2):
+        """read pages in a single preallocated array and merge buffered parts"""
+        data, jobs = self.plan_range(name, pages, idx1, idx2)
+        for page, idx, rec, ii1 in jobs:
+            page.read_into(self.pagedir, idx, rec, ii1)
+        return self.merge_parts(data, parts)
+
+    def plan_range(self, name, pages, idx1, idx2):
+        """
+        Allocate the data of pages between idx1 and idx2, or None if empty,
+        and return it with the reads filling it: page, idx and rec slices
+        and first record
+        """
+        slices = [page.locate(self.pagedir, idx1, idx2) for page in pages]
+        count = sum(ii2 - ii1 for ii1, ii2 in slices)
+        if count == 0:
+            return None, []
+        idx = np.empty(count, dtype=pages[0].idx_type)
+        rec = np.empty(count, dtype=type2dtype(pages[0].rec_type))
+        jobs = []
+        pos = 0
+        for page, (ii1, ii2) in zip(pages, slices):
+            end = pos + ii2 - ii1
+            if end > pos:
+                jobs.append((page, idx[pos:end], rec[pos:end], ii1))
+            pos = end
+        return Data(idx, rec, name), jobs
+
+    @staticmethod
+    def merge_parts(data, parts):
+        if parts is not None:
+            # buffered data costs an additional merge
+            buffered = Data.concatenate_list(parts)
+            if len(buffered) > 0:
+                data = buffered if data is None else data.merge(buffered)[0]
+        return data
+
+    # Point queries
+    def value_at(self, name, idx):
+        """
+        Return the last record of name with index before idx included,
+        as Data with one record, or None. Only that record is read.
+        """
+        for attempt in range(self.read_retries):
+            with self.lock:
+                self.refresh()
+                page = self.get_page_before(name, idx)
+                buffered = None if self.buffer is None else self.buffer.get(name)
+            try:
+                data = None
+                if page is not None:
+                    idxs = page.read_idx(self.pagedir, mmap=True)
+                    ii = np.searchsorted(idxs, idx, side="right") - 1
+                    data = page.read_slice(self.pagedir, ii, ii + 1)
+                if buffered is not None:
+                    ii = np.searchsorted(buffered.idx, idx, side="right") - 1
+                    if ii >= 0 and (data is None or buffered.idx[ii] >= data.idx[0]):
+                        data = buffered.cut_idx(ii)[1].cut_idx(1)[0]
+                return data
+            except FileNotFoundError:
+                # page replaced by a writer, look it up again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def first_value(self, name):
+        """return the first record of name as Data with one record, or None"""
+        for attempt in range(self.read_retries):
+            with self.lock:
+                self.refresh()
+                page = self.get_page_after(name, -np.infty)
+                buffered = None if self.buffer is None else self.buffer.get(name)
+            try:
+                data = None
+                if page is not None:
+                    data = page.read_slice(self.pagedir, 0, 1)
+                if buffered is not None and len(buffered) > 0:
+                    if data is None or buffered.idx[0] <= data.idx[0]:
+                        data = buffered.cut_idx(1)[0]
+                return data
+            except FileNotFoundError:
+                # page replaced by a writer, look it up again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def last_value(self, name):
+        """return the last record of name as Data with one record, or None"""
+        with self.lock:
+            self.check_tails()
+            return self.get_tail(name)
+
+    def check_tails(self):
+        """clear the cached last records if another process wrote meanwhile"""
+        data_version = self.get_data_version()
+        if data_version != self.tails_version:
+            self.tails.clear()
+            self.tails_version = data_version
+
+    def get_tail(self, name):
+        """return the cached last record of name, looking it up if missing"""
+        tail = self.tails.get(name)
+        if tail is None:
+            tail = self.value_at(name, np.infty)
+            if tail is not None:
+                self.tails[name] = tail
+        return tail
+
+    def update_tail(self, data):
+        """update the last record of the name of data, if cached"""
+        tail = self.tails.get(data.name)
+        if tail is not None and len(data) > 0 and data.end() >= tail.end():
+            idx, rec = data.idx[-1:].copy(), data.rec[-1:].copy()
+            self.tails[data.name] = Data(idx, rec, data.name)
+
+    def first(self, pattern_or_list=""):
+        """return a DataSet with the first record of each name"""
+        res = {}
+        for name in self.get_point_names(pattern_or_list):
+            data = self.first_value(name)
+            if data is not None:
+                res[name] = data
+        return DataSet(res)
+
+    def last(self, pattern_or_list=""):
+        """
+        Return a DataSet with the last record of each name,
+        cached per name and updated by writes
+        """
+        res = {}
+        with self.lock:
+            self.check_tails()
+            for name in self.get_point_names(pattern_or_list):
+                data = self.get_tail(name)
+                if data is not None:
+                    res[name] = data
+        return DataSet(res)
+
+    def get_point_names(self, pattern_or_list):
+        """
+        Names matching a pattern or the names in a list, without checking
+        that they are stored: their lookups return None otherwise
+        """
+        if type(pattern_or_list) is str:
+            return self.get_names(pattern_or_list)
+        return pattern_or_list
 
     def get_names(self, pattern_or_list=""):
+        buffered = [] if self.buffer is None else list(self.buffer)
         if type(pattern_or_list) is str:
             pattern = pattern_or_list
-            return [k for k in self.search(pattern) if pattern in k]
+            names = set(self.search(f"%{pattern}%")) | set(buffered)
+            return sorted(k for k in names if pattern in k)
         else:
             lst = pattern_or_list
-            return [k for k in lst if self.count_pages(k) > 0]
+            return [k for k in lst if k in buffered or self.count_pages(k) > 0]
 
     def get(self, pattern_or_list, idx1=-np.infty, idx2=np.infty):
-        res = {
-            name: self.get_data(name, idx1, idx2)
-            for name in self.get_names(pattern_or_list)
-        }
+        """return a DataSet of the names between idx1 and idx2, see get_many"""
+        return self.get_many(self.get_names(pattern_or_list), idx1, idx2)
+
+    def get_many(self, requests, idx1=-np.infty, idx2=np.infty):
+        """
+        Return a DataSet with the data of each request: a name, read between
+        idx1 and idx2, or a tuple of name, idx1 and idx2.
+
+        The pages of all names are looked up at once, then the page slices
+        are read in parallel by read_workers threads, each directly in the
+        preallocated result of its name. Names without data are omitted.
+        """
+        ranges = {}
+        for request in requests:
+            if isinstance(request, str):
+                ranges[request] = idx1, idx2
+            else:
+                name, start, stop = request
+                ranges[name] = start, stop
+        plans = self.get_ranges(ranges)
+        executor = self.get_read_executor()
+        reads = {}
+        for name, (pages, parts) in plans.items():
+            start, stop = ranges[name]
+            if self.can_read_range(pages, self.mmap):
+                try:
+                    data, jobs = self.plan_range(name, pages, start, stop)
+                except FileNotFoundError:
+                    jobs = None
+                if jobs is not None:
+                    futures = [
+                        executor.submit(page.read_into, self.pagedir, idx, rec, ii1)
+                        for page, idx, rec, ii1 in jobs
+                    ]
+                    reads[name] = True, data, futures
+                    continue
+            future = executor.submit(self.get_data, name, start, stop)
+            reads[name] = False, None, [future]
+        res = {}
+        for name, (planned, data, futures) in reads.items():
+            try:
+                results = [future.result() for future in futures]
+                if planned:
+                    data = self.merge_parts(data, plans[name][1])
+                else:
+                    data = results[0]
+            except FileNotFoundError:
+                # pages replaced by a writer, get_data looks them up again
+                data = self.get_data(name, *ranges[name])
+            if data is not None:
+                res[name] = data
         return DataSet(res)
 
+    def get_read_executor(self):
+        if self.read_executor is None:
+            self.read_executor = ThreadPoolExecutor(max_workers=self.read_workers)
+        return self.read_executor
+
+    def gen_blocks(self, name, idx1, idx2, mmap):
+        """
+        Yield page and data of the pages between idx1 and idx2. Data is None
+        for pages without buffered data, that are read only by read_block,
+        page is None for buffered data after or without pages.
+        """
+        pages, parts = self.get_range(name, idx1, idx2)
+        if len(pages) == 0:
+            if parts is not None and len(parts[0]) > 0:
+                yield None, parts[0]
+            return
+        for ii, page in enumerate(pages):
+            part = None if parts is None else parts[ii]
+            if part is None or len(part) == 0:
+                yield page, None
+            else:
+                data = self.read_block(page, idx1, idx2, mmap)
+                yield page, part if len(data) == 0 else data.merge(part)[0]
+
+    def select(
+        self,
+        name,
+        idx1=-np.infty,
+        idx2=np.infty,
+        idx_test=None,
+        rec_test=None,
+        limit=None,
+        skip=0,
+        offset=0,
+        where=None,
+        mmap=None,
+    ):
+        """
+        Return the records of name between idx1 and idx2 matching the tests,
+        see Data.select, down selected as matched[offset:offset+limit:skip+1].
+
+        Pages are read one at a time until limit is reached, without tests
+        the pages before offset are counted from the catalog and not read.
+        Return Data without records if nothing is selected and None if name
+        is not stored.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        filtered = idx_test is not None or rec_test is not None or where is not None
+        stop = np.infty if limit is None else offset + limit
+        step = skip + 1
+        for attempt in range(self.read_retries):
+            try:
+                count = 0
+                res = []
+                for page, data in self.gen_blocks(name, idx1, idx2, mmap):
+                    if count >= stop:
+                        break
+                    if data is None:
+                        if not filtered:
+                            ii1, ii2 = page.locate(self.pagedir, idx1, idx2)
+                            if count + ii2 - ii1 <= offset:
+                                count += ii2 - ii1
+                                continue
+                        elif where is not None:
+                            if not where_can_match(where, page.get_stats()):
+                                continue
+                        data = self.read_block(page, idx1, idx2, mmap)
+                    if filtered:
+                        mask = data.mask(None, None, idx_test, rec_test, where)
+                        data = data.filter(mask)
+                    first = first_position(count, offset, step)
+                    last = min(stop, count + len(data))
+                    if first < last:
+                        ii1, ii2 = first - count, last - count
+                        res.append(
+                            Data(data.idx[ii1:ii2:step], data.rec[ii1:ii2:step], name)
+                        )
+                    count += len(data)
+                if len(res) == 0:
+                    return self.empty_data(name)
+                return self.concatenate(res)
+            except FileNotFoundError:
+                # pages replaced by a writer, read them again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def empty_data(self, name):
+        """return Data without records with the types of name or None"""
+        page = self.get_last_page(name)
+        if page is not None:
+            return page.read_slice(self.pagedir, 0, 0)
+        buffered = None if self.buffer is None else self.buffer.get(name)
+        if buffered is not None:
+            return buffered.cut_idx(0)[0]
+
+    def count(
+        self,
+        name,
+        idx1=-np.infty,
+        idx2=np.infty,
+        idx_test=None,
+        rec_test=None,
+        limit=None,
+        skip=0,
+        offset=0,
+        where=None,
+        mmap=None,
+    ):
+        """
+        Count the records of name between idx1 and idx2 matching the tests
+        among the ones at positions offset:offset+limit:skip+1. Positions
+        start from the first record at or after idx1, as in
+        get_data(name, idx1, idx2).count(...), while Data.count counts them
+        from its first record whatever idx1.
+
+        Without tests, pages without buffered data are counted from the
+        catalog, the pages at the edges of the range are searched but not read.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        filtered = idx_test is not None or rec_test is not None or where is not None
+        stop = np.infty if limit is None else offset + limit
+        step = skip + 1
+        for attempt in range(self.read_retries):
+            try:
+                pos = 0
+                res = 0
+                for page, data in self.gen_blocks(name, idx1, idx2, mmap):
+                    if pos >= stop:
+                        break
+                    if data is None:
+                        ii1, ii2 = page.locate(self.pagedir, idx1, idx2)
+                        count = ii2 - ii1
+                    else:
+                        count = len(data)
+                    first = first_position(pos, offset, step)
+                    last = min(stop, pos + count)
+                    if first >= last:
+                        pos += count
+                        continue
+                    if not filtered:
+                        res += len(range(first, last, step))
+                    elif data is not None or where_can_match(where, page.get_stats()):
+                        if data is None:
+                            data = self.read_block(page, idx1, idx2, mmap)
+                        mask = data.mask(None, None, idx_test, rec_test, where)
+                        res += int(mask[first - pos : last - pos : step].sum())
+                    pos += count
+                return res
+            except FileNotFoundError:
+                # pages replaced by a writer, count them again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def filter(self, name, where, idx1=-np.infty, idx2=np.infty, mmap=None):
+        """
+        Return the records of name between idx1 and idx2 matching where: a
+        Cond, a condition string like "x > 3", a function of the idx and rec
+        arrays returning a mask or a list of them. Pages whose statistics
+        exclude a match are not read. Return Data without records if nothing
+        matches, or None if name has no data.
+        """
+        if mmap is None:
+            mmap = self.mmap
+        for attempt in range(self.read_retries):
+            pages, parts = self.get_range(name, idx1, idx2)
+            if len(pages) > 0:
+                keep = [
+                    ii
+                    for ii, page in enumerate(pages)
+                    if (parts is not None and len(parts[ii]) > 0)
+                    or where_can_match(where, page.get_stats())
+                ]
+                pages = [pages[ii] for ii in keep]
+                if parts is not None:
+                    parts = [parts[ii] for ii in keep] if len(keep) > 0 else None
+            try:
+                datalist = self.gen_page_data(pages, idx1, idx2, mmap, parts)
+                datalist = [data.where(where) for data in datalist]
+                datalist = [data for data in datalist if len(data) > 0]
+                if len(datalist) == 0:
+                    return self.empty_data(name)
+                return self.concatenate(datalist)
+            except FileNotFoundError:
+                # pages replaced by a writer, read them again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def aggregate(self, name, idx1=-np.infty, idx2=np.infty, field=None):
+        """
+        Return count, min, max, sum, sumsq, mean and std of the records of
+        name between idx1 and idx2 included, or of field for structured
+        records. Pages inside the range are summarized by the statistics in
+        the catalog, only the pages at the edges of the range are read.
+        """
+        key = "" if field is None else field
+        for attempt in range(self.read_retries):
+            pages, parts = self.get_range(name, idx1, idx2)
+            try:
+                return self.aggregate_pages(pages, parts, idx1, idx2, key)
+            except FileNotFoundError:
+                # pages replaced by a writer, read them again
+                if attempt == self.read_retries - 1:
+                    raise
+
+    def aggregate_pages(self, pages, parts, idx1, idx2, key):
+        """combine the catalog statistics of covered pages and read the others"""
+        stats = []
+        count = 0
+        partial = []
+        partial_parts = None if parts is None else []
+        if len(pages) == 0 and parts is not None:
+            partial_parts.append(parts[0])
+        for ii, page in enumerate(pages):
+            part = None if parts is None else parts[ii]
+            page_stats = page.get_stats()
+            if (
+                page.begin >= idx1
+                and page.end <= idx2
+                and page_stats is not None
+                and key in page_stats
+                and (part is None or len(part) == 0)
+            ):
+                stats.append(page_stats[key])
+                count += page.count
+            else:
+                partial.append(page)
+                if parts is not None:
+                    partial_parts.append(part)
+        if partial_parts is not None and len(partial_parts) == 0:
+            # every page summarized by its statistics
+            partial_parts = None
+        for data in self.gen_page_data(partial, idx1, idx2, self.mmap, partial_parts):
+            stats.append(field_stats(data.rec if key == "" else data.rec[key]))
+            count += len(data)
+        if len(stats) == 0:
+            return summary(None, 0)
+        return summary(reduce(combine_field_stats, stats), count)
+
     # Consistency check
-    def check(self):
-        last = -np.infty
-        for page in self.pages:
-            if page.begin < last:
-                raise ValueError("page {page} collide")
-            last = page.end
+    def verify(self, workers=4):
+        """
+        Check that pages of each name do not overlap and that the page files
+        agree with the catalog, verifying hashes in parallel with workers
+        threads. Return a report with the number of pages, the problems found
+        per pageid and the page files not referenced by the catalog.
+        """
+        with self.lock:
+            self.refresh()
+            pages = list(self.gen_pages_all())
+        errors = {}
+        last = {}
+        for page in sorted(pages, key=lambda page: (page.name, page.begin)):
+            if page.begin > page.end:
+                errors.setdefault(page.pageid, []).append("begin after end")
+            if page.name in last and page.begin <= last[page.name].end:
+                msg = f"overlaps page {last[page.name].pageid}"
+                errors.setdefault(page.pageid, []).append(msg)
+            last[page.name] = page
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda page: page.verify(self.pagedir), pages)
+            for page, res in zip(pages, results):
+                if len(res) > 0:
+                    errors.setdefault(page.pageid, []).extend(res)
+        if len(errors) > 0:
+            # ignore pages replaced by a writer meanwhile
+            current = {(page.pageid, page.version) for page in self.gen_pages_all()}
+            for page in pages:
+                if (page.pageid, page.version) not in current:
+                    errors.pop(page.pageid, None)
+        return {
+            "pages": len(pages),
+            "errors": errors,
+            "orphans": self.find_orphans(),
+        }
+
+    def find_orphans(self):
+        """
+        Return the page files in pagedir not referenced by the catalog,
+        including files written or deleted by a writer meanwhile
+        """
+        # versions kept for snapshots are referenced also without copy on write
+        sql = """SELECT pageid, version FROM pages
+               UNION SELECT pageid, version FROM history"""
+        prefixes = set()
+        for pageid, version in self.db.execute(sql):
+            page = Page(pageid, None, None, None, None, None, None, version=version)
+            prefixes.add(page.get_prefix(self.pagedir))
+        orphans = []
+        for filename in self.walk_pagedir():
+            prefix, extension = os.path.splitext(filename)
+            if extension in (".idx", ".rec", ".page") and prefix not in prefixes:
+                orphans.append(filename)
+        return sorted(orphans)
+
+    def walk_pagedir(self):
+        """yield the files in pagedir, except the ones of the pyramid store"""
+        for root, dirs, files in os.walk(self.pagedir):
+            if root == self.pagedir and "pyramid" in dirs:
+                dirs.remove("pyramid")
+            for filename in files:
+                yield os.path.join(root, filename)
+
+    def recover(self, workers=4, rebuild=False):
+        """
+        Repair catalog and page files after an unclean shutdown.
+
+        Pages with missing or truncated files are removed from the catalog,
+        files left longer by an interrupted append are truncated and
+        temporary and unreferenced page files are deleted. If rebuild is
+        True, the catalog is first rebuilt from the meta files in pagedir.
+        Return a report with the lost and repaired pages and deleted files.
+        """
+        report = {"rebuilt": 0, "lost": [], "repaired": [], "deleted": []}
+        with self.lock, self.batch():
+            for filename in self.walk_pagedir():
+                if filename.endswith(".tmp"):
+                    os.unlink(filename)
+                    report["deleted"].append(filename)
+            if rebuild:
+                report["rebuilt"] = self.rebuild_catalog(workers)
+            pages = list(self.gen_pages_all())
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                verify = lambda page: page.verify(self.pagedir, hash=False)
+                results = list(executor.map(verify, pages))
+            for page, errors in zip(pages, results):
+                if len(errors) == 0:
+                    continue
+                if page.repair(self.pagedir):
+                    self.invalidate_page(page)
+                    report["repaired"].append(page)
+                else:
+                    self.delete_page(page)
+                    report["lost"].append(page)
+            for filename in self.find_orphans():
+                os.unlink(filename)
+                report["deleted"].append(filename)
+        return report
+
+    def rebuild_catalog(self, workers=4):
+        """
+        Replace the pages in the catalog with the ones described by the meta
+        files in pagedir, read in parallel. The last version of each pageid
+        is used and, among overlapping pages, the most recently written.
+        Pages in the catalog whose meta file cannot be used are kept as they
+        are and checked by recover(). Return the number of pages in the new
+        catalog.
+        """
+        known = {
+            page.get_prefix(self.pagedir) + ".page": page
+            for page in self.gen_pages_all()
+        }
+        filenames = {name for name in self.walk_pagedir() if name.endswith(".page")}
+        filenames = sorted(filenames | known.keys())
+
+        def read_meta(filename):
+            try:
+                with open(filename, "rb") as fh:
+                    page = pickle.load(fh)
+                if page.get_prefix(self.pagedir) + ".page" != filename:
+                    page = None
+                elif len(page.verify(self.pagedir, hash=False)) > 0:
+                    page = None
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+                page = None
+            if page is None:
+                page = known.get(filename)
+            if page is None:
+                return None
+            try:
+                return os.path.getmtime(filename), page
+            except OSError:
+                # missing meta file of a page in the catalog
+                return 0, page
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            metas = [res for res in executor.map(read_meta, filenames) if res]
+        latest = {}
+        for mtime, page in sorted(metas, key=lambda res: res[1].version):
+            latest[page.pageid] = mtime, page
+        for page in list(self.gen_pages_all()):
+            self.remove_page(page.pageid)
+        selected = Catalog()
+        for mtime, page in sorted(latest.values(), key=lambda res: -res[0]):
+            if len(selected.get_pages_between(page.name, page.begin, page.end)) == 0:
+                selected.insert(page)
+                self.insert_page(page)
+        if self.cache is not None:
+            self.cache.clear()
+        return len(selected.pageids)
+
+    def check(self, workers=4):
+        """raise ValueError if verify finds any problem in the pages"""
+        errors = self.verify(workers)["errors"]
+        if len(errors) > 0:
+            raise ValueError(f"Pages with problems: {errors}")
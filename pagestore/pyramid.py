@@ -0,0 +1,46 @@
+import numpy as np
+
+from .data import Data
+
+# records of the downsampled levels, one per bucket
+level_dtype = np.dtype(
+    [("min", float), ("max", float), ("mean", float), ("count", np.int64)]
+)
+
+
+def level_name(name, level):
+    return f"{name}/{level}"
+
+
+def bucket_range(idx1, idx2, width):
+    """begin of the bucket of idx1 and end, excluded, of the bucket of idx2"""
+    return idx1 // width * width, idx2 // width * width + width
+
+
+def to_level(data, field=None):
+    """return data as level records, one per record of scalar values"""
+    values = data.rec if field is None else data.rec[field]
+    if values.ndim != 1 or values.dtype.kind not in "biuf":
+        raise ValueError(f"Cannot downsample records of type {values.dtype}")
+    rec = np.empty(len(values), dtype=level_dtype)
+    rec["min"] = values
+    rec["max"] = values
+    rec["mean"] = values
+    rec["count"] = 1
+    return Data(data.idx, rec, data.name)
+
+
+def downsample(data, width, name):
+    """
+    Aggregate level records of data in buckets of width,
+    the index of each bucket is its begin
+    """
+    buckets = data.idx // width * width
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    rec = data.rec
+    out = np.empty(len(starts), dtype=level_dtype)
+    out["min"] = np.minimum.reduceat(rec["min"], starts)
+    out["max"] = np.maximum.reduceat(rec["max"], starts)
+    out["count"] = np.add.reduceat(rec["count"], starts)
+    out["mean"] = np.add.reduceat(rec["mean"] * rec["count"], starts) / out["count"]
+    return Data(buckets[starts], out, name)
@@ -0,0 +1,75 @@
+import numpy as np
+
+from .data import DataSet
+
+
+class Snapshot:
+    """
+    Read-only view of a copy on write PageStore at a given store version.
+
+    Pages visible in the snapshot are never rewritten and are not deleted by
+    PageStore.gc() until the snapshot is closed, so reads need no locks and
+    no retries while the store is written.
+    """
+
+    def __init__(self, store, version, snapshotid=None):
+        self.store = store
+        self.version = version
+        self.snapshotid = snapshotid
+
+    def __repr__(self):
+        return f"<Snapshot of '{self.store.pagedir}' at version {self.version}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """release the snapshot, its pages can be deleted by gc()"""
+        if self.snapshotid is not None:
+            self.store.release_snapshot(self.snapshotid)
+            self.snapshotid = None
+
+    def get_pages(self, name):
+        return self.store.get_history_pages(self.version, name)
+
+    def get_pages_between(self, name, idx1, idx2):
+        return self.store.get_history_pages(self.version, name, idx1, idx2)
+
+    def search(self, pattern="%"):
+        return self.store.search_history(self.version, pattern)
+
+    def iter_data(self, name, idx1=-np.infty, idx2=np.infty, chunk=None, mmap=None):
+        """yield data of name between idx1 and idx2 included, see PageStore"""
+        if mmap is None:
+            mmap = self.store.mmap
+        pages = self.get_pages_between(name, idx1, idx2)
+        datalist = self.store.gen_page_data(pages, idx1, idx2, mmap)
+        yield from self.store.gen_chunks(name, datalist, chunk)
+
+    def get_data(self, name, idx1=-np.infty, idx2=np.infty, mmap=None):
+        """return data of name between idx1 and idx2 included"""
+        if mmap is None:
+            mmap = self.store.mmap
+        pages = self.get_pages_between(name, idx1, idx2)
+        if not self.store.can_read_range(pages, mmap):
+            datalist = self.store.gen_page_data(pages, idx1, idx2, mmap)
+            return self.store.concatenate(datalist)
+        return self.store.read_range(name, pages, None, idx1, idx2)
+
+    def get_names(self, pattern_or_list=""):
+        if type(pattern_or_list) is str:
+            pattern = pattern_or_list
+            return [k for k in self.search() if pattern in k]
+        else:
+            names = set(self.search())
+            return [k for k in pattern_or_list if k in names]
+
+    def get(self, pattern_or_list, idx1=-np.infty, idx2=np.infty):
+        res = {
+            name: self.get_data(name, idx1, idx2)
+            for name in self.get_names(pattern_or_list)
+        }
+        return DataSet(res)
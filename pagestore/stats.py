@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def field_stats(values):
+    """return min, max, sum and sum of squares of numeric values along axis 0"""
+    if values.dtype.kind not in "biuf":
+        raise ValueError(f"No statistics for values of type {values.dtype}")
+    return {
+        "min": values.min(axis=0).tolist(),
+        "max": values.max(axis=0).tolist(),
+        "sum": values.sum(axis=0, dtype=float).tolist(),
+        "sumsq": np.square(values, dtype=float).sum(axis=0).tolist(),
+    }
+
+
+def combine_field_stats(st1, st2):
+    return {
+        "min": np.minimum(st1["min"], st2["min"]).tolist(),
+        "max": np.maximum(st1["max"], st2["max"]).tolist(),
+        "sum": np.add(st1["sum"], st2["sum"]).tolist(),
+        "sumsq": np.add(st1["sumsq"], st2["sumsq"]).tolist(),
+    }
+
+
+def rec_stats(rec):
+    """
+    Return min, max, sum and sum of squares of the numeric fields of rec,
+    per field name or "" for non structured records, as lists for JSON
+    """
+    if rec.dtype.names is None:
+        fields = {"": rec}
+    else:
+        fields = {name: rec[name] for name in rec.dtype.names}
+    stats = {}
+    for name, values in fields.items():
+        if values.dtype.kind in "biuf" and len(values) > 0:
+            stats[name] = field_stats(values)
+    return stats
+
+
+def combine_stats(stats1, stats2):
+    """combine the statistics of two sets of records, None if missing"""
+    if stats1 is None or stats2 is None:
+        return None
+    return {
+        name: combine_field_stats(stats1[name], stats2[name])
+        for name in stats1.keys() & stats2.keys()
+    }
+
+
+def summary(stats, count):
+    """return count, min, max, sum, sumsq, mean and std from the statistics"""
+    res = {"count": count}
+    for key in ["min", "max", "sum", "sumsq", "mean", "std"]:
+        res[key] = None
+    if count == 0:
+        return res
+    for key in ["min", "max", "sum", "sumsq"]:
+        res[key] = np.asarray(stats[key])[()]
+    res["mean"] = res["sum"] / count
+    res["std"] = np.sqrt(np.maximum(res["sumsq"] / count - res["mean"] ** 2, 0))
+    return res
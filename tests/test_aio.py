@@ -0,0 +1,34 @@
+import asyncio
+import os
+
+import numpy as np
+
+from pagestore import AsyncPageStore, Data, PageStore
+
+
+def mk_data(a, b, n, name):
+    idx = np.linspace(a, b, n)
+    rec = idx ** 3
+    return Data(idx, rec, name)
+
+
+def test_async_pagestore(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+
+    async def main():
+        async with AsyncPageStore(PageStore(basedir, max_page_size=400)) as adb:
+            writes = [
+                adb.store_data(mk_data(ii, ii + 9, 10, "a")) for ii in range(0, 100, 10)
+            ]
+            dataset = {"b": mk_data(0, 9, 10, "b"), "c": mk_data(0, 9, 10, "c")}
+            await asyncio.gather(*writes, adb.store(dataset))
+            assert await adb.search() == ["a", "b", "c"]
+            data = await adb.get_data("a", 10, 19)
+            assert all(data.idx == np.arange(10, 20))
+            res = await adb.get(["a", "b", "d"], 5, 50)
+            assert list(res) == ["a", "b"] and len(res["a"]) == 46
+            chunks = [data async for data in adb.iter_data("a", chunk=30)]
+            assert [len(data) for data in chunks] == [30, 30, 30, 10]
+
+    asyncio.run(main())
+    assert PageStore(basedir).count_records("a") == 100
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+from pagestore import Data, WriteBuffer
+
+
+def mk_data(a, b, n, name):
+    idx = np.linspace(a, b, n)
+    rec = idx ** 3
+    return Data(idx, rec, name)
+
+
+def test_store_data():
+    buffer = WriteBuffer(max_count=20)
+    buffer.store_data(mk_data(0, 9, 10, "a"))
+    buffer.store_data(mk_data(5, 14, 10, "a"))
+    assert buffer.count == 15
+    assert not buffer.is_full()
+    buffer.store_data(mk_data(0, 9, 10, "b"))
+    assert buffer.is_full()
+    assert list(buffer) == ["a", "b"]
+    buffer.clear()
+    assert len(buffer) == 0
+
+
+def test_wal(tmp_path):
+    walfile = os.path.join(tmp_path, "wal")
+    buffer = WriteBuffer(walfile=walfile)
+    buffer.store_data(mk_data(0, 9, 10, "a"))
+    buffer.store_data(mk_data(5, 14, 10, "a"))
+    buffer.close()
+    # torn last entry
+    with open(walfile, "ab") as fh:
+        fh.write(b"\x80\x04\x95")
+    buffer = WriteBuffer(walfile=walfile)
+    assert all(buffer.get("a").idx == np.arange(15))
+    buffer.clear()
+    buffer.close()
+    assert os.path.getsize(walfile) == 0
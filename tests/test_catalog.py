@@ -0,0 +1,50 @@
+import numpy as np
+
+from pagestore import Data, Page
+from pagestore.catalog import Catalog
+
+
+def mk_page(pageid, a, b, name="a"):
+    idx = np.linspace(a, b, 11)
+    return Page.from_data(pageid, Data(idx, idx ** 3, name))
+
+
+def test_catalog():
+    catalog = Catalog([mk_page(3, 2, 3), mk_page(1, 0, 1), mk_page(2, 0, 1, "b")])
+    assert catalog.new_pageid() == 4
+    assert catalog.count_pages("a") == 2
+    assert [page.pageid for page in catalog.get_pages("a")] == [1, 3]
+    assert catalog.get_page_before("a", -1) is None
+    assert catalog.get_page_before("a", 1.5).pageid == 1
+    assert catalog.get_page_before("a", 2).pageid == 3
+    assert catalog.get_page_after("a", 1.5).pageid == 3
+    assert catalog.get_page_after("a", 2) is None
+    assert catalog.get_last_page("a").pageid == 3
+    assert len(catalog.get_pages_between("a", 0.5, 2.5)) == 2
+    assert len(catalog.get_pages_between("a", 1.5, 1.8)) == 0
+    assert len(catalog.get_pages_between("a", 2.5, 3.5)) == 1
+    assert len(catalog.get_pages_begin_between("a", 0, 2)) == 1
+    catalog.insert(mk_page(1, 0, 1.5))
+    assert catalog.count_pages("a") == 2
+    assert catalog.get_page(1).end == 1.5
+    catalog.remove(1)
+    catalog.remove(3)
+    assert catalog.count_pages("a") == 0
+    assert catalog.get_pages("a") == []
+
+
+def test_catalog_updates():
+    pages = [Page(ii, "a", 10 * ii, 10 * ii + 9, 10, 80, "<i8") for ii in range(100)]
+    catalog = Catalog(pages[::-1])
+    index = catalog.names["a"]
+    catalog.insert(Page(100, "a", 1000, 1009.5, 10, 80, "<f8"))
+    catalog.insert(Page(101, "a", 4.5, 5.5, 2, 16, "<f8"))
+    catalog.remove(50)
+    catalog.insert(Page(7, "a", 70, 75, 5, 40, "<i8"))
+    begins = [page.begin for page in index.pages]
+    assert begins == sorted(begins) and len(begins) == 101
+    assert list(index.begins) == begins
+    assert list(index.ends) == [page.end for page in index.pages]
+    assert catalog.get_page_before("a", 4.7).pageid == 101
+    assert catalog.get_page_before("a", 509).pageid == 49
+    assert catalog.get_page(7).end == 75
@@ -156,3 +156,52 @@ def test_iterate():
 
     data = mk_data(-4, 6, 11, "test")
     assert data.iterate(avg()) == data.mean()
+
+
+def test_merge_replaced():
+    data1 = mk_data(0, 10, 11, "a")
+    data2 = Data([2.5, 3, 5, 5.5, 12], [-1, -2, -3, -4, -5], "a")
+    data3, data4 = data1.merge(data2)
+    assert all(data3.idx == [0, 1, 2, 2.5, 3, 4, 5, 5.5, 6, 7, 8, 9, 10, 12])
+    assert all(data3.rec[[3, 4, 6, 7, 13]] == data2.rec)
+    assert all(data4.idx == [3, 5])
+    assert all(data4.rec == [27, 125])
+
+
+def test_merge_structured():
+    dtype = [("x", float), ("y", int, (2,))]
+    rec1 = np.zeros(5, dtype=dtype)
+    rec1["x"] = np.arange(5)
+    rec2 = np.ones(3, dtype=dtype)
+    data1 = Data(np.arange(5), rec1, "a")
+    data2 = Data([1, 3, 7], rec2, "a")
+    data3, data4 = data1.merge(data2)
+    assert all(data3.idx == [0, 1, 2, 3, 4, 7])
+    assert all(data3.rec["x"] == [0, 1, 2, 1, 4, 1])
+    assert data3.rec["y"].shape == (6, 2)
+    assert all(data4.rec["x"] == [1, 3])
+
+
+def test_merge_multidim():
+    data1 = Data(np.arange(4), np.zeros((4, 3)), "a")
+    data2 = Data([1.5, 2], np.ones((2, 3)), "a")
+    data3, data4 = data1.merge(data2)
+    assert data3.rec.shape == (5, 3)
+    assert all(data3.rec[:, 0] == [0, 0, 1, 1, 0])
+    assert data4.rec.shape == (1, 3)
+
+
+def test_split():
+    data = mk_data(0, 10, 11, "a")
+    parts = data.split([2.5, 3, 9, 20])
+    assert [len(part) for part in parts] == [3, 0, 6, 2, 0]
+    assert all(parts[2].idx == [3, 4, 5, 6, 7, 8])
+
+
+def test_where():
+    idx = np.arange(10)
+    data = Data(idx, idx * 0.5, "test")
+    assert list(data.where("rec > 3").idx) == [7, 8, 9]
+    assert data.count(where="rec > 3") == 3
+    data = data.select(idx2=8, where=lambda idx, rec: idx % 2 == 0)
+    assert list(data.idx) == [0, 2, 4, 6, 8]
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from pagestore import Cond
+from pagestore.filters import where_mask, where_can_match
+
+
+def test_cond():
+    cond = Cond.parse("x >= 2.5")
+    assert (cond.field, cond.op, cond.value) == ("x", ">=", 2.5)
+    assert Cond.parse("rec != 'a'").field is None
+    with pytest.raises(ValueError):
+        Cond.parse("x =< 3")
+    rec = np.zeros(5, dtype=[("x", float), ("y", int, (2,))])
+    rec["x"] = np.arange(5)
+    rec["y"][3] = [0, 7]
+    idx = np.arange(5)
+    assert list(cond.mask(idx, rec)) == [False, False, False, True, True]
+    assert list(Cond("y", ">", 5).mask(idx, rec)) == [0, 0, 0, 1, 0]
+    mask = where_mask(["x > 0", lambda idx, rec: idx < 4], idx, rec)
+    assert list(mask) == [False, True, True, True, False]
+
+
+def test_can_match():
+    stats = {"": {"min": 1.0, "max": 3.0, "sum": 6.0, "sumsq": 14.0}}
+    assert Cond(None, ">", 2).can_match(stats)
+    assert not Cond(None, ">", 3).can_match(stats)
+    assert Cond(None, ">=", 3).can_match(stats)
+    assert not Cond(None, "<", 1).can_match(stats)
+    assert not Cond(None, "==", 4).can_match(stats)
+    assert Cond(None, "!=", 2).can_match(stats)
+    assert Cond("x", "<", 0).can_match(stats)
+    assert Cond(None, ">", 3).can_match(None)
+    assert not where_can_match(["rec > 2", "rec < 0"], stats)
+    assert where_can_match(lambda idx, rec: rec > 10, stats)
+    stats[""]["max"] = float("nan")
+    assert Cond(None, ">", 3).can_match(stats)
@@ -1,7 +1,7 @@
 import numpy as np
 
 from pagestore import Page, Data
-from pagestore.page import num2path
+from pagestore.page import num2path, type2dtype
 
 
 def check_with_data(self, data):
@@ -48,3 +48,118 @@ def test_read_write(tmp_path):
     page.write(data, basedir)
     page.check(basedir)
     page.delete(basedir)
+
+
+def test_read_mmap(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, idx ** 2, "test")
+    page = Page.from_data(123, data)
+    page.write(data, tmp_path)
+    data1 = page.read(tmp_path, mmap=True)
+    assert not data1.idx.flags.writeable
+    assert data1.compare(data)
+
+
+def test_rec_type(tmp_path):
+    dtype = [("x", float), ("y", "<i4", (3,))]
+    rec = np.zeros((10, 2), dtype=dtype)
+    rec["x"] = np.arange(20).reshape(10, 2)
+    data = Data(np.arange(10), rec, "test")
+    page = Page.from_data(12, data)
+    assert np.dtype((dtype, (2,))) == type2dtype(page.rec_type)
+    # each rec_type is parsed once, also when read by worker threads
+    assert type2dtype(page.rec_type) is type2dtype(page.rec_type)
+    page.write(data, tmp_path)
+    for mmap in [False, True]:
+        data1 = page.read(tmp_path, mmap)
+        assert data1.rec.shape == (10, 2)
+        assert all(data1.rec["x"].flatten() == np.arange(20))
+        assert data1.rec["y"].shape == (10, 2, 3)
+
+
+def test_read_pickled(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, idx ** 2, "test")
+    page = Page.from_data(123, data)
+    page.rec_type = None
+    page.write(data, tmp_path)
+    page = Page(*page.to_list()[:7])
+    assert page.read(tmp_path).compare(data)
+
+
+def test_read_into(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, np.c_[idx, idx ** 2], "test")
+    page = Page.from_data(123, data)
+    page.write(data, tmp_path)
+    assert page.locate(tmp_path, -1, 200) == (0, 100)
+    ii1, ii2 = page.locate(tmp_path, 10.5, 20)
+    assert (ii1, ii2) == (11, 21)
+    idx = np.empty(ii2 - ii1)
+    rec = np.empty((ii2 - ii1, 2))
+    page.read_into(tmp_path, idx, rec, ii1)
+    assert all(idx == np.arange(11, 21))
+    assert all(rec[:, 1] == idx ** 2)
+
+
+def test_hash(tmp_path, monkeypatch):
+    # blocks of 4 records
+    monkeypatch.setattr(Page, "hash_block_size", 64)
+    idx = np.arange(0, 100.0)
+    data = Data(idx, idx ** 2, "test")
+    page = Page.from_data(123, data)
+    page.write(data, tmp_path)
+    assert page.hash == page.compute_hash(tmp_path)
+    assert page.read_meta(tmp_path).hash == page.hash
+    for ii in range(100, 110):
+        page.append(Data([ii, ii + 0.5], [1.0, 2.0], "test"), tmp_path)
+        assert page.hash == page.compute_hash(tmp_path)
+    assert page.verify(tmp_path) == []
+    # the hash does not depend on how records were appended
+    data = page.read(tmp_path)
+    other = Page.from_data(124, data)
+    other.write(data, tmp_path)
+    assert other.hash == page.hash
+    with open(page.get_prefix(tmp_path) + ".rec", "r+b") as fh:
+        fh.write(b"x")
+    assert page.verify(tmp_path) == ["hash differs"]
+    page.delete(tmp_path)
+    assert "FileNotFoundError" in page.verify(tmp_path)[0]
+
+
+def test_stats(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, idx ** 2, "test")
+    page = Page.from_data(123, data)
+    stats = page.get_stats()[""]
+    assert stats["min"] == 0 and stats["max"] == 99 ** 2
+    assert stats["sum"] == (idx ** 2).sum()
+    assert stats["sumsq"] == (idx ** 4).sum()
+    page.write(data, tmp_path)
+    page.append(Data([100.0], [-1.0], "test"), tmp_path)
+    stats = page.get_stats()[""]
+    assert stats["min"] == -1 and stats["sum"] == (idx ** 2).sum() - 1
+    assert page.read_meta(tmp_path).stats == page.stats
+
+
+def test_read_slice(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, np.c_[idx, idx ** 2], "test")
+    page = Page.from_data(123, data)
+    page.write(data, tmp_path)
+    part = page.read_slice(tmp_path, 10, 13)
+    assert all(part.idx == [10, 11, 12]) and all(part.rec[:, 1] == [100, 121, 144])
+    page.rec_type = None
+    page.write(data, tmp_path)
+    assert all(page.read_slice(tmp_path, 99, 100).idx == [99])
+
+
+def test_read_range(tmp_path):
+    idx = np.arange(0, 100.0)
+    data = Data(idx, idx ** 2, "test")
+    page = Page.from_data(123, data)
+    page.write(data, tmp_path)
+    part = page.read_range(tmp_path, 10.5, 13)
+    assert all(part.idx == [11, 12, 13]) and all(part.rec == [121, 144, 169])
+    assert len(page.read_range(tmp_path, 200, 300)) == 0
+    assert len(page.read_range(tmp_path, -1, 200)) == 100
@@ -1,8 +1,16 @@
+import gc
+import multiprocessing
 import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import time
 
 import numpy as np
+import pytest
 
-from pagestore import Page, Data, PageStore
+from pagestore import Cond, Page, Data, PageStore, WriteBuffer
 
 
 def mk_data(a, b, n, name):
@@ -11,6 +19,26 @@ def mk_data(a, b, n, name):
     return Data(idx, rec, name)
 
 
+def count_reads(db):
+    """return the list of pages read by db, appended at each read"""
+    reads = []
+    read_block = db.read_block
+
+    def read(page, *args):
+        reads.append(page)
+        return read_block(page, *args)
+
+    db.read_block = read
+    return reads
+
+
+def crash(db):
+    """leave db as a writer killed without closing it"""
+    db.marker_finalizer.detach()
+    db.marker.close()
+    db.db.close()
+
+
 def test_pagestore(tmp_path):
     basedir = os.path.join(tmp_path, "mydb")
     db = PageStore(basedir, max_page_size=100)
@@ -41,7 +69,8 @@ def test_dbop(tmp_path):
     assert page1 is None
 
     db.remove_page(page.pageid)
-    assert db.new_pageid() == 0
+    # pageids are never reused
+    assert db.new_pageid() == 125
 
     db.delete()
 
@@ -160,3 +189,790 @@ def test_search(tmp_path):
 
     assert db.search("a%") == ["a", "aa"]
     assert db.search() == ["a", "aa", "b", "c"]
+
+
+def test_get_data_mmap(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=100, mmap=True)
+    db.store_data(mk_data(0, 10, 11, "a"))
+    db.store_data(mk_data(5, 15, 11, "a"))
+    data = db.get_data("a", 2, 4)
+    assert all(data.idx == [2, 3, 4])
+    assert all(data.rec == data.idx ** 3)
+    data = db.get_data("a", 2, 14, mmap=False)
+    assert all(data.idx == np.arange(2, 15))
+    assert all(data.rec == data.idx ** 3)
+
+
+def test_upgrade_db(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    os.makedirs(basedir)
+    db = sqlite3.connect(os.path.join(basedir, "pagestore.db"))
+    sql = """CREATE TABLE pages(pageid INTEGER PRIMARY KEY, name STRING,
+      begin NUMERIC, end NUMERIC, count INTEGER, size INTEGER, idx_type STRING)"""
+    db.execute(sql)
+    db.execute("INSERT INTO pages VALUES (0, 'a', 0, 1, 2, 16, '<f8')")
+    db.commit()
+    db = PageStore(basedir)
+    assert db.get_page(0).rec_type is None
+    db.store_data(mk_data(0, 10, 11, "b"))
+    assert db.get_pages("b")[0].rec_type == "('<f8', ())"
+
+
+def test_cache(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=10000, cache_size=1000)
+    db.store_data(mk_data(0, 10, 11, "a"))
+    key = db.get_page(0).cache_key()
+    db.get_data("a", 2, 4)
+    db.get_data("a", 3, 5)
+    assert db.cache_info()["hits"] == 1
+    assert db.cache_info()["misses"] == 1
+    db.store_data(Data([4.5], [-1.0], "a"))
+    assert key not in db.cache
+    assert all(db.get_data("a", 4, 5).rec == [64, -1, 125])
+    db.store_data(mk_data(11, 1000, 990, "a"))
+    assert db.cache.size <= 1000
+
+
+def test_batch(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=100)
+    db.store_data(mk_data(0, 10, 11, "a"))
+    page = db.get_pages("a")[0]
+    with db.batch():
+        db.store_data(mk_data(5, 15, 11, "a"))
+        db.store_data(mk_data(5, 15, 11, "b"))
+        assert db.db.in_transaction
+        # replaced page files are deleted after commit
+        assert os.path.exists(page.get_prefix(db.pagedir) + ".idx")
+    assert not db.db.in_transaction
+    assert not os.path.exists(page.get_prefix(db.pagedir) + ".idx")
+    assert db.count_records("a") == 16
+    assert db.count_records("b") == 11
+
+
+def test_batch_rollback(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=100)
+    db.store_data(mk_data(0, 10, 11, "a"))
+    try:
+        with db.batch():
+            db.store_data(mk_data(5, 15, 11, "a"))
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    pages = db.get_pages("a")
+    assert len(pages) == 1
+    assert len(pages[0].read(db.pagedir)) == 11
+    files = [ff for _, _, ff in os.walk(basedir) for ff in ff if ff.endswith(".idx")]
+    assert len(files) == 1
+    # pages extended in place are truncated
+    for catalog in [False, True]:
+        db = PageStore(basedir, max_page_size=400, catalog=catalog)
+        try:
+            with db.batch():
+                db.store_data(mk_data(11, 20, 10, "a"))
+                db.store_data(mk_data(21, 22, 2, "a"))
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        db.check()
+        assert all(db.get_data("a").idx == np.arange(11))
+
+
+def test_store_many_pages(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    assert db.count_pages("a") == 2
+    data = mk_data(-10, 120, 131, "a")
+    data.rec[:] = -1
+    db.store_data(data)
+    data = db.get_data("a")
+    assert len(data) == 131
+    assert all(data.rec[np.isin(data.idx, np.arange(100.0))] == -1)
+    pages = db.get_pages("a")
+    assert all(page.size <= 400 for page in pages)
+    assert all(p1.end < p2.begin for p1, p2 in zip(pages[:-1], pages[1:]))
+
+
+def test_store_replace(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=10000)
+    db.store({"a": ([1, 2, 3], [0.1, 0.2, 0.3])})
+    db.store({"a": ([3, 4, 5], [0.35, 0.45, 0.55])})
+    assert all(db.get_data("a", 2, 4).rec == [0.2, 0.35, 0.45])
+
+
+def test_append(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 9, 10, "a"))
+    db.store_data(mk_data(10, 19, 10, "a"))
+    pages = db.get_pages("a")
+    assert len(pages) == 1
+    assert pages[0].version == 0
+    assert pages[0].count == 20
+    assert pages[0].end == 19
+    db.store_data(mk_data(20, 99, 80, "a"))
+    pages = db.get_pages("a")
+    assert [page.count for page in pages] == [50, 50]
+    assert pages[0].version == 0
+    data = db.get_data("a")
+    assert all(data.idx == np.arange(100))
+    assert all(data.rec == data.idx ** 3)
+    pages[0].check(db.pagedir)
+
+
+def test_buffer(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    walfile = os.path.join(tmp_path, "wal")
+    db = PageStore(basedir, buffer=WriteBuffer(max_count=30, walfile=walfile))
+    db.store_data(mk_data(0, 9, 10, "a"))
+    db.store_data(mk_data(10, 19, 10, "b"))
+    assert db.count_pages_all() == 0
+    assert db.get_names("") == ["a", "b"]
+    assert all(db.get_data("a", 2, 4).idx == [2, 3, 4])
+    db.store_data(mk_data(5, 24, 20, "a"))
+    assert db.count_pages_all() == 2
+    assert len(db.buffer) == 0
+    db.store_data(mk_data(20, 29, 10, "b"))
+    data = db.get_data("b", 15, 25)
+    assert all(data.idx == np.arange(15, 26))
+    db.buffer.close()
+    db = PageStore(basedir, buffer=WriteBuffer(walfile=walfile))
+    assert db.get_data("b").end() == 29
+    db.close()
+    db = PageStore(basedir)
+    assert db.count_records("b") == 20
+
+
+def test_buffer_age(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, buffer=WriteBuffer(max_age=0.01))
+    db.store_data(mk_data(0, 9, 10, "a"))
+    for ii in range(100):
+        if db.count_pages_all() > 0:
+            break
+        time.sleep(0.01)
+    assert db.count_records("a") == 10
+    db.close()
+
+
+def test_iter_data(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    for ii in range(0, 200, 50):
+        db.store_data(mk_data(ii, ii + 49, 50, "a"))
+    chunks = list(db.iter_data("a", 10.5, 150))
+    assert [len(data) for data in chunks] == [39, 50, 50, 1]
+    assert chunks[0].begin() == 11
+    assert chunks[-1].end() == 150
+    chunks = list(db.iter_data("a", 10.5, 150, chunk=30))
+    assert [len(data) for data in chunks] == [30, 30, 30, 30, 20]
+    data = Data.concatenate_list(chunks)
+    assert all(data.idx == np.arange(11, 151))
+    assert list(db.iter_data("a", 300, 400)) == []
+
+
+def test_iter_data_buffer(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer())
+    assert list(db.iter_data("a")) == []
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.flush()
+    data = mk_data(-5.5, 104.5, 111, "a")
+    db.store_data(data)
+    data = db.get_data("a")
+    assert len(data) == 211
+    assert all(np.diff(data.idx) > 0)
+    assert all(data.rec == data.idx ** 3)
+
+
+def test_get_data_preallocated(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=800)
+    for ii in range(0, 200, 50):
+        idx = np.arange(ii, ii + 50)
+        db.store_data(Data(idx, np.c_[idx, -idx], "a"))
+    assert db.count_pages("a") == 4
+    data = db.get_data("a", 10.5, 150)
+    assert data.rec.shape == (140, 2)
+    assert all(data.idx == np.arange(11, 151))
+    assert all(data.rec[:, 1] == -data.idx)
+    assert db.get_data("a", 300, 400) is None
+
+
+def test_catalog(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, catalog=True)
+    for ii in range(0, 200, 50):
+        db.store_data(mk_data(ii, ii + 49, 50, "a"))
+    db.store_data(mk_data(-10, 220, 231, "a"))
+    db.store_data(mk_data(-10, 220, 231, "b"))
+    db2 = PageStore(basedir)
+    for name in ["a", "b"]:
+        pages = db.get_pages(name)
+        assert len(pages) == db2.count_pages(name)
+        for page1, page2 in zip(pages, db2.get_pages(name)):
+            assert page1.compare(page2)
+        for idx in [-20, 0, 20.5, 49, 50, 250]:
+            page = db.get_page_before(name, idx)
+            assert page is None or page.compare(db2.get_page_before(name, idx))
+            page = db.get_page_after(name, idx)
+            assert page is None or page.compare(db2.get_page_after(name, idx))
+    assert all(db.get_data("a", 100, 110).idx == np.arange(100, 111))
+
+
+def test_rebalance_dirty(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, catalog=True)
+    data = mk_data(0, 999, 1000, "a")
+    db.store_data(data)
+    pages = db.get_pages("a")
+    assert len(pages) == 20
+    assert all(page.count == 50 for page in pages)
+    versions = {page.pageid: page.version for page in pages}
+    db.store_data(Data([100.5, 900.5], [1, 2], "a"))
+    pages = db.get_pages("a")
+    assert len(pages) == 22
+    assert all(page.size <= 400 for page in pages)
+    changed = [page for page in pages if versions.get(page.pageid) != page.version]
+    assert len(changed) == 4
+    assert db.count_records("a") == 1002
+
+
+def test_concurrent_reader(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    writer = PageStore(basedir, max_page_size=400)
+    reader = PageStore(basedir, max_page_size=400, catalog=True)
+    for ii in range(0, 200, 50):
+        writer.store_data(mk_data(ii, ii + 49, 50, "a"))
+    assert len(reader.get_data("a")) == 200
+    chunks = reader.iter_data("a")
+    assert all(next(chunks).idx == np.arange(50))
+    # all pages are replaced while reading
+    data = mk_data(0, 199, 200, "a")
+    data.rec[:] = -1
+    writer.store_data(data)
+    data = Data.concatenate_list(list(chunks))
+    assert all(data.idx == np.arange(50, 200))
+    assert all(data.rec == -1)
+    assert reader.count_records("a") == 200
+    assert os.path.exists(os.path.join(basedir, "pagestore.lock"))
+
+
+def test_refresh_changed_names(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    writer = PageStore(basedir, max_page_size=400)
+    writer.store_data(mk_data(0, 99, 100, "a"))
+    writer.store_data(mk_data(0, 99, 100, "b"))
+    reader = PageStore(basedir, mode="r")
+    index = reader.catalog.names["a"]
+    writer.store_data(mk_data(100, 199, 100, "b"))
+    writer.store_data(mk_data(0, 9, 10, "c"))
+    assert len(reader.get_data("b")) == 200
+    # only the changed names are loaded again
+    assert reader.catalog.names["a"] is index
+    assert reader.catalog.count_records("c") == 10
+    writer.delete_name("b")
+    assert reader.get_data("b") is None
+    assert sorted(reader.catalog.names) == ["a", "c"]
+    assert len(reader.catalog.pageids) == writer.count_pages_all()
+    # catalogs without changes are loaded again completely
+    for trigger in ["pages_insert", "pages_update", "pages_delete"]:
+        writer.db.execute(f"DROP TRIGGER {trigger}")
+    writer.db.execute("DROP TABLE changes")
+    writer.store_data(mk_data(10, 19, 10, "c"))
+    assert len(reader.get_data("c")) == 20
+
+
+def store_process(basedir, name):
+    db = PageStore(basedir, max_page_size=400)
+    # backwards, so that pages are merged and rebalanced
+    for ii in range(180, -20, -20):
+        db.store_data(mk_data(ii, ii + 19, 20, name))
+    db.close()
+
+
+def test_concurrent_writers(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    PageStore(basedir).close()
+    procs = [
+        multiprocessing.Process(target=store_process, args=(basedir, name))
+        for name in ["a", "b", "c"]
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    db = PageStore(basedir)
+    pageids = []
+    for name in ["a", "b", "c"]:
+        data = db.get_data(name)
+        assert len(data) == 200
+        assert all(data.rec == data.idx ** 3)
+        pages = db.get_pages(name)
+        pageids.extend(page.pageid for page in pages)
+        for page in pages:
+            page.check(db.pagedir)
+    assert len(pageids) == len(set(pageids))
+
+
+def test_read_only(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    with pytest.raises(sqlite3.OperationalError):
+        PageStore(basedir, mode="r")
+    assert not os.path.exists(basedir)
+    db = PageStore(basedir, max_page_size=400)
+    # the WAL journal is checkpointed also if other connections are open
+    other = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.close()
+    for immutable in [False, True]:
+        reader = PageStore(basedir, mode="r", immutable=immutable)
+        assert reader.catalog is not None
+        assert reader.mmap
+        assert all(reader.get_data("a", 10, 20).idx == np.arange(10, 21))
+        with pytest.raises(PermissionError):
+            reader.store_data(mk_data(0, 99, 100, "a"))
+        with pytest.raises(PermissionError):
+            reader.delete()
+        reader.close()
+    other.close()
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(100, 199, 100, "a"))
+    reader = PageStore(basedir, mode="r")
+    assert reader.count_records("a") == 200
+
+
+@pytest.mark.parametrize("catalog", [False, True])
+def test_reader_deleted_name(tmp_path, catalog):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, catalog=catalog)
+    db.store_data(mk_data(0, 9, 10, "a"))
+    db.store_data(mk_data(0, 99, 100, "b"))
+    reader = PageStore(basedir, mode="r", catalog=catalog)
+    pages, parts = reader.get_range("b", 0, 99)
+    # the files of the deleted pages are not reused by the pages of c
+    db.delete_name("b")
+    db.store_data(Data(np.arange(100.0), -np.ones(100), "c"))
+    assert min(page.pageid for page in db.get_pages("c")) > max(
+        page.pageid for page in pages
+    )
+    datalist = list(reader.gen_range_data("b", 0, 99, False, pages, parts))
+    assert all(all(data.rec >= 0) for data in datalist)
+    assert sum(len(data) for data in datalist) in [0, 100]
+    last = max(page.pageid for page in db.get_pages("c"))
+    db.delete_name("c")
+    db.close()
+    db = PageStore(basedir, catalog=catalog)
+    assert db.new_pageid() == last + 1
+
+
+def test_snapshot(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, cow=True)
+    with pytest.raises(ValueError):
+        PageStore(os.path.join(tmp_path, "other")).snapshot()
+    db.store_data(mk_data(0, 99, 100, "a"))
+    snap = db.snapshot()
+    assert snap.version == db.get_version() == 1
+    db.store_data(Data([10, 200], [-1.0, -2.0], "a"))
+    db.store_data(mk_data(0, 9, 10, "b"))
+    assert db.get_version() == 3
+    data = db.get_data("a")
+    assert len(data) == 101 and data.rec[10] == -1
+    old = snap.get_data("a")
+    assert all(old.idx == np.arange(100)) and old.rec[10] == 1000
+    assert snap.get_names() == ["a"]
+    assert sum(len(d) for d in snap.iter_data("a", chunk=7)) == 100
+    # replaced pages are kept while the snapshot is registered
+    assert db.gc() == 0
+    assert all(snap.get_data("a", 5, 15).rec == np.arange(5, 16) ** 3)
+    snap.close()
+    assert db.gc() > 0
+    with db.snapshot() as snap:
+        assert snap.get("").to_dict().keys() == {"a", "b"}
+    files = [name for name in os.listdir(basedir) if not name.startswith("pagestore")]
+    pages = list(db.gen_pages_all())
+    assert len(files) == 3 * len(pages)
+    # changes done without copy on write are recorded when reopened
+    db.close()
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(300, 309, 10, "a"))
+    db.close()
+    db = PageStore(basedir, max_page_size=400, cow=True)
+    with db.snapshot() as snap:
+        assert snap.get_data("a").end() == 309
+    # snapshots of readers are kept by the writer
+    db.gc()
+    before = db.get_data("a")
+    reader = PageStore(basedir, mode="r", cow=True)
+    snap = reader.snapshot()
+    db.store_data(mk_data(0, 309, 310, "a"))
+    assert db.gc() == 0
+    assert all(snap.get_data("a").idx == before.idx)
+    snap.close()
+    assert db.gc() > 0
+
+
+def test_verify(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.store_data(mk_data(0, 9, 10, "b"))
+    report = db.verify(workers=2)
+    assert report == {"pages": 3, "errors": {}, "orphans": []}
+    db.check()
+    page = db.get_pages("a")[1]
+    with open(page.get_prefix(basedir) + ".idx", "r+b") as fh:
+        fh.write(b"x")
+    orphan = Page.from_data(100, mk_data(0, 9, 10, "c"))
+    orphan.write(mk_data(0, 9, 10, "c"), basedir)
+    report = db.verify()
+    assert report["errors"] == {page.pageid: ["hash differs"]}
+    assert len(report["orphans"]) == 3
+    with pytest.raises(ValueError):
+        db.check()
+
+
+def test_recover(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.store_data(mk_data(0, 9, 10, "b"))
+    lost = db.get_pages("a")[0]
+    os.unlink(lost.get_prefix(basedir) + ".idx")
+    torn = db.get_pages("b")[0]
+    for extension in [".idx", ".rec"]:
+        with open(torn.get_prefix(basedir) + extension, "ab") as fh:
+            fh.write(b"torn")
+    orphan = Page.from_data(100, mk_data(0, 9, 10, "c"))
+    orphan.write(mk_data(0, 9, 10, "c"), basedir)
+    open(orphan.get_prefix(basedir) + ".idx.tmp", "w").close()
+    crash(db)
+    db = PageStore(basedir, max_page_size=400)
+    report = db.recovery
+    assert [page.pageid for page in report["lost"]] == [lost.pageid]
+    assert [page.pageid for page in report["repaired"]] == [torn.pageid]
+    assert len(report["deleted"]) == 4 + 2
+    assert db.verify() == {"pages": 2, "errors": {}, "orphans": []}
+    assert all(db.get_data("a").idx == np.arange(50, 100))
+    assert all(db.get_data("b").idx == np.arange(10))
+    db.close()
+    assert not os.path.exists(os.path.join(basedir, "pagestore.dirty"))
+    db = PageStore(basedir, max_page_size=400)
+    assert db.recovery is None
+    # rebuild the catalog from the meta files
+    db.db.execute("DELETE FROM pages")
+    db.db.commit()
+    assert db.recover(rebuild=True)["rebuilt"] == 2
+    assert db.get_names() == ["a", "b"]
+    assert all(db.get_data("a").idx == np.arange(50, 100))
+
+
+def test_recover_snapshot(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, cow=True)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    snap = PageStore(basedir, mode="r", cow=True).snapshot()
+    db.store_data(Data(np.arange(100.0), -np.ones(100), "a"))
+    crash(db)
+    # recovery without copy on write keeps the pages of the snapshot
+    db = PageStore(basedir, max_page_size=400)
+    assert db.recovery["deleted"] == []
+    old = snap.get_data("a")
+    assert len(old) == 100 and all(old.rec == old.idx ** 3)
+    snap.close()
+
+
+def test_marker_at_exit(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    markerfile = os.path.join(basedir, "pagestore.dirty")
+    script = f"""if True:
+        from pagestore import PageStore, Data
+        db = PageStore({basedir!r})
+        db.store_data(Data([1.0, 2.0], [3.0, 4.0], "a"))
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], cwd=root, check=True)
+    assert not os.path.exists(markerfile)
+    db = PageStore(basedir)
+    assert db.recovery is None and os.path.exists(markerfile)
+    del db
+    gc.collect()
+    assert not os.path.exists(markerfile)
+    with PageStore(basedir) as db:
+        assert db.recovery is None
+        assert len(db.get_data("a")) == 2
+    assert not os.path.exists(markerfile)
+
+
+def make_legacy(db):
+    """rewrite the pages as written by older versions, with pickled records"""
+    for page in db.get_pages("a"):
+        data = db.read_page(page, mmap=False)
+        page.delete(db.pagedir)
+        legacy = Page(*page.to_list()[:7])
+        for key in ["rec_type", "version", "hash", "stats"]:
+            del legacy.__dict__[key]
+        prefix = legacy.get_prefix(db.pagedir)
+        data.idx.tofile(prefix + ".idx")
+        with open(prefix + ".rec", "wb") as fh:
+            pickle.dump(data.rec, fh)
+        with open(prefix + ".page", "wb") as fh:
+            pickle.dump(legacy, fh)
+    sql = """UPDATE pages SET rec_type = NULL, version = 0, hash = NULL,
+           stats = NULL"""
+    db.db.execute(sql)
+    db.db.commit()
+
+
+def test_recover_legacy(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    make_legacy(db)
+    assert db.verify()["errors"] == {}
+    assert db.recover(rebuild=True)["rebuilt"] == 2
+    assert all(db.get_data("a").idx == np.arange(100))
+    # unreadable meta files of pages in the catalog do not lose the pages
+    for page in db.get_pages("a"):
+        with open(page.get_prefix(basedir) + ".page", "wb") as fh:
+            fh.write(b"garbage")
+    report = db.recover(rebuild=True)
+    assert report["rebuilt"] == 2 and len(report["repaired"]) == 2
+    assert report["lost"] == [] and report["deleted"] == []
+    assert all(db.get_data("a").idx == np.arange(100))
+    crash(db)
+    db = PageStore(basedir, max_page_size=400)
+    assert db.recovery["lost"] == []
+    assert all(db.get_data("a").idx == np.arange(100))
+
+
+def test_aggregate(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 999, 1000, "a"))
+    reads = count_reads(db)
+    res = db.aggregate("a", 10.5, 900)
+    values = np.arange(11, 901) ** 3
+    assert res["count"] == len(values)
+    assert res["min"] == values.min() and res["max"] == values.max()
+    assert np.isclose(res["sum"], values.sum())
+    assert np.isclose(res["mean"], values.mean())
+    assert np.isclose(res["std"], values.std())
+    assert len(reads) == 2
+    assert db.aggregate("a", 2000, 3000)["mean"] is None
+    # pages extended by appends and structured records
+    rec = np.zeros(10, dtype=[("x", float), ("y", "<i4", (2,))])
+    rec["x"] = np.arange(10)
+    rec["y"] = np.arange(20).reshape(10, 2)
+    db.store_data(Data(np.arange(1000, 1010), rec["x"], "a"))
+    db.store_data(Data(np.arange(10), rec, "b"))
+    assert db.aggregate("a", 999)["count"] == 11
+    assert db.aggregate("b", field="x")["sum"] == 45
+    assert all(db.aggregate("b", 0, 4, field="y")["max"] == [8, 9])
+    with pytest.raises(ValueError):
+        db.aggregate("b")
+
+
+def test_aggregate_buffer(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer())
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.flush()
+    db.store_data(Data([50, 200], [-1.0, -2.0], "a"))
+    data = db.get_data("a")
+    res = db.aggregate("a")
+    assert res["count"] == len(data) == 101
+    assert res["min"] == -2 and res["max"] == data.rec.max()
+    assert np.isclose(res["sum"], data.rec.sum())
+    # all pages in the range covered, buffered data outside of it
+    res = db.aggregate("a", 0, 49.5)
+    assert res["count"] == 50 and res["max"] == 49 ** 3
+
+
+def test_pyramid(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=4000)
+    idx = np.arange(10000.0)
+    db.store_data(Data(idx, idx % 7, "a"))
+    db.set_pyramid("a", 10, factor=10, levels=3)
+    level = db.get_data("a", max_points=2000)
+    assert len(level) == 1000 and all(level.idx == idx[::10])
+    assert all(level.rec["count"] == 10)
+    assert np.allclose(level.rec["mean"], (idx % 7).reshape(-1, 10).mean(axis=1))
+    level = db.get_data("a", max_points=50)
+    assert len(level) == 10 and level.rec["max"][0] == 6
+    assert len(db.get_data("a", 25, 74, max_points=3)) == 1
+    assert len(db.get_data("a", 25, 74, max_points=100)) == 50
+    # levels are updated by writes
+    db.store_data(Data([15.0, 10005.0], [-100.0, 100.0], "a"))
+    level = db.get_data("a", 10, 10100, max_points=20)
+    assert all(level.idx == np.arange(0, 10001, 1000))
+    assert level.rec["min"][0] == -100 and level.rec["count"][0] == 1000
+    assert level.rec["max"][-1] == 100 and level.rec["count"][-1] == 1
+    level = db.get_level_data("a", 1, 10, 19)
+    assert level.rec["mean"][0] == ((idx[10:20] % 7).sum() - 1 - 100) / 10
+    assert db.verify()["orphans"] == []
+    db.close()
+    reader = PageStore(basedir, mode="r")
+    assert len(reader.get_data("a", max_points=2000)) == 1001
+    # the levels of deleted names are deleted as well
+    db = PageStore(basedir, max_page_size=4000)
+    db.delete_name("a")
+    db.store_data(Data(idx[:500], -np.ones(500), "a"))
+    level = db.get_data("a", max_points=20)
+    assert len(level) == 5 and all(level.rec["mean"] == -1)
+    assert all(level.rec["count"] == 100)
+
+
+def test_filter(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer())
+    db.store_data(mk_data(0, 999, 1000, "a"))
+    db.flush()
+    reads = count_reads(db)
+    data = db.filter("a", f"rec > {950 ** 3}")
+    assert all(data.idx == np.arange(951, 1000))
+    assert len(reads) == 1
+    empty = db.filter("a", Cond(None, "<", 0))
+    assert len(empty) == 0 and empty.rec.dtype == data.rec.dtype
+    assert db.filter("missing", "rec > 0") is None
+    assert len(reads) == 1
+    # buffered data is always read
+    db.store_data(Data([10], [-1.0], "a"))
+    data = db.filter("a", ["rec < 0", lambda idx, rec: idx > 5], 0, 500)
+    assert all(data.idx == [10])
+
+
+def test_select_count(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer())
+    db.store_data(mk_data(0, 999, 1000, "a"))
+    db.flush()
+    db.store_data(Data([100.5, 2000], [-1.0, -2.0], "a"))
+    tests = [
+        {},
+        {"where": "rec > 1000"},
+        {"rec_test": lambda rec: rec < 1e6, "where": lambda idx, rec: idx % 3 > 0},
+    ]
+    for kwargs in tests:
+        for idx1, idx2 in [(-np.infty, np.infty), (95, 812.5), (5000, 6000)]:
+            data = db.get_data("a", idx1, idx2)
+            for limit, skip, offset in [(None, 0, 0), (10, 0, 60), (100, 4, 333)]:
+                args = dict(limit=limit, skip=skip, offset=offset, **kwargs)
+                res = db.select("a", idx1, idx2, **args)
+                if data is None:
+                    assert len(res) == 0 and res.rec.dtype == float
+                    assert db.count("a", idx1, idx2, **args) == 0
+                    continue
+                expected = data.select(**args)
+                assert all(res.idx == expected.idx)
+                assert all(res.rec == expected.rec)
+                assert db.count("a", idx1, idx2, **args) == data.count(**args)
+    reads = count_reads(db)
+    assert db.select("b") is None
+    data = db.select("a", 510.5, limit=10)
+    assert all(data.idx == np.arange(511, 521))
+    assert len(reads) == 1
+    assert db.count("a", 510.5) == 490
+    # only the last page, merged with buffered data, is read
+    assert len(reads) == 2
+
+
+def test_first_last(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400)
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.store_data(mk_data(10, 19, 10, "b"))
+    assert db.value_at("a", 50.5).idx[0] == 50
+    assert db.value_at("a", 1000).rec[0] == 99 ** 3
+    assert db.value_at("a", -1) is None
+    assert db.value_at("c", 1) is None
+    first = db.first()
+    assert first["a"].idx[0] == 0 and first["b"].idx[0] == 10
+    last = db.last(["a", "b", "c"])
+    assert last["a"].idx[0] == 99 and last["b"].rec[0] == 19 ** 3
+    assert "c" not in last
+    # the tail is updated by writes
+    assert "a" in db.tails
+    db.store_data(Data([50, 200], [-1.0, -2.0], "a"))
+    assert db.tails["a"].idx[0] == 200
+    assert db.last("a")["a"].rec[0] == -2
+    # and cleared when another process writes
+    other = PageStore(basedir)
+    other.store_data(Data([300], [-3.0], "a"))
+    other.close()
+    assert db.last("a")["a"].rec[0] == -3
+    # cached records are served with a single check of the database
+    calls = []
+    get_data_version = db.get_data_version
+    db.get_data_version = lambda: calls.append(1) or get_data_version()
+    assert list(db.last(["b", "c", "a"])) == ["b", "a"]
+    assert len(calls) == 1
+
+
+def test_first_last_buffer(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer())
+    db.store_data(mk_data(0, 99, 100, "a"))
+    db.flush()
+    db.store_data(Data([-5, 50.5, 150], [-1.0, -2.0, -3.0], "a"))
+    assert db.first("a")["a"].idx[0] == -5
+    assert db.last("a")["a"].idx[0] == 150
+    assert db.value_at("a", 60).idx[0] == 60
+    assert db.value_at("a", 50.7).rec[0] == -2
+
+
+def test_narrow_reads(tmp_path, monkeypatch):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=10 ** 7)
+    db.store_data(mk_data(0, 99999, 100000, "a"))
+
+    def read(*args, **kwargs):
+        raise AssertionError("whole page read")
+
+    monkeypatch.setattr(Page, "read", read)
+    assert db.get_data("a", 500, 500).rec[0] == 500 ** 3
+    assert len(db.get_data("a", 500, 599)) == 100
+    assert sum(len(data) for data in db.iter_data("a", 10.5, 20)) == 10
+    assert all(db.select("a", 1000, limit=3).idx == [1000, 1001, 1002])
+    assert db.filter("a", "rec < 8", 0, 10).idx[-1] == 1
+
+
+def test_get_many(tmp_path):
+    basedir = os.path.join(tmp_path, "mydb")
+    db = PageStore(basedir, max_page_size=400, buffer=WriteBuffer(), read_workers=3)
+    for ii in range(20):
+        db.store_data(mk_data(0, 99, 100, f"v{ii:02}"))
+    db.flush()
+    db.store_data(Data([10.5, 200], [-1.0, -2.0], "v00"))
+    names = db.get_names("v")
+    res = db.get("v", 5, 150)
+    assert list(res) == names
+    for name in names:
+        expected = db.get_data(name, 5, 150)
+        assert all(res[name].idx == expected.idx) and all(res[name].rec == expected.rec)
+    assert len(res["v00"]) == 96 and res["v00"].rec[6] == -1
+    # the pages of all names are looked up in one query
+    queries = []
+    db.db.set_trace_callback(queries.append)
+    plans = db.get_ranges({"v01": (90, 99), "v02": (10, 19), "missing": (0, 1)})
+    db.db.set_trace_callback(None)
+    assert sum("FROM pages" in sql for sql in queries) == 1
+    assert [len(plans[name][0]) for name in plans] == [1, 1, 0]
+    res = db.get_many(["v01", ("v02", 10, 19), ("v03", 500, 600), "missing"], 90)
+    assert list(res) == ["v01", "v02"]
+    assert len(res["v01"]) == 10 and len(res["v02"]) == 10
+    # cached and mapped pages are read by get_data
+    for kwargs in [{"cache_size": 10 ** 6}, {"mmap": True}]:
+        other = PageStore(basedir, max_page_size=400, **kwargs)
+        res = other.get(["v05", "v06"], 40, 60)
+        assert all(res["v05"].idx == np.arange(40, 61))
+        other.close()
+    db.close()
+    assert db.read_executor is None